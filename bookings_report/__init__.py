@@ -0,0 +1,3 @@
+# Bookings table index kinds (see `bookings_report.tables.get_bookings_index`), kept here so that
+# the command line can offer them without importing sqlalchemy
+BOOKINGS_INDEX_KINDS = ['restaurant_month', 'date_brin']
@@ -1,11 +1,38 @@
+import decimal
+import logging
+import time
+from typing import Any, Dict, Optional
+
 import sqlalchemy
 from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.ext.declarative import declarative_base
 
+from bookings_report.psql_utils import EXPLAIN_OPTIONS, create_index
+from bookings_report.tables import get_bookings_index
+
+LOGGER = logging.getLogger(__name__)
+
 MappedTable = declarative_base()
 
+# Standard normal quantile for 95% confidence intervals
+CONFIDENCE_Z = decimal.Decimal('1.96')
+
+# Maximum time to wait for readers of report table to release it before giving up a swap attempt;
+# short, since readers arriving meanwhile queue behind the swap
+SWAP_LOCK_TIMEOUT = '200ms'
+
+# Swap attempts, and delay before the second one (in seconds, doubled after each attempt)
+SWAP_MAX_ATTEMPTS = 6
+SWAP_RETRY_DELAY = 0.5
+
+# PostgreSQL error code of lock timeouts
+LOCK_NOT_AVAILABLE = '55P03'
+
 
-def aggregate_report(bookings_table: MappedTable, report_table: MappedTable, engine: Engine):
+def aggregate_report(bookings_table: MappedTable, report_table: MappedTable, engine: Engine,
+                     explain: bool = False,
+                     fx_rates_table: Optional[MappedTable] = None,
+                     streaming: bool = False, publish: bool = False) -> Optional[Dict[str, Any]]:
     """
     Aggregate bookings table into a monthly report, and replace report table content with it.
 
@@ -13,17 +40,102 @@ def aggregate_report(bookings_table: MappedTable, report_table: MappedTable, eng
         bookings_table: source bookings table mapper
         report_table: destination report table mapper
         engine: sqlalchemy engine
+        explain: whether to capture the query plan of the aggregation
+        fx_rates_table: FX rates table mapper, for converting amounts to a single currency into
+            report table `converted_amount` column (see :func:`get_report_table`)
+        streaming: whether to aggregate bookings group by group, instead of hashing them all at
+            once; bookings are read in (restaurant, month) order through a `restaurant_month`
+            index (see :func:`get_bookings_index`), created if missing, so that only bookings of
+            a single restaurant and month are held in memory at a time
+        publish: whether to build the report into a shadow table, then swap it with report table,
+            instead of truncating report table; readers of report table are not blocked during
+            aggregation, only during the swap (retried with backoff while they hold report
+            table); report table owner, privileges and dependent views are carried over to the
+            new report table; concurrent publications of the same report table are serialized
+
+    Returns:
+        Aggregation query plan as PostgreSQL JSON `EXPLAIN` output if `explain`, else `None`
 
     Notes:
         Make the operation transactional.
     """
 
+    report_table_name = report_table.__tablename__
+
+    if not publish:
+        with engine.begin() as connection:
+            if streaming:
+                _prepare_streaming_aggregation(bookings_table, connection)
+
+            # Truncate already-existing report table
+            _run_truncate_query(report_table, connection)
+
+            # Recreate report
+            return _run_aggregate_report_query(bookings_table, report_table_name, connection,
+                                               explain, fx_rates_table)
+
+    shadow_table_name = f'{report_table_name}_shadow'
+
+    with engine.connect() as connection:
+        # Concurrent publications would share (and drop) the same shadow table; wait for them
+        with connection.begin():
+            _run_advisory_lock_query(report_table_name, connection)
+
+        try:
+            # Create an empty copy of report table, dropping leftovers of a failed run if any
+            with connection.begin():
+                _run_create_shadow_table_query(report_table_name, shadow_table_name, connection)
+
+            # Build report into shadow table, without locking report table
+            with connection.begin():
+                if streaming:
+                    _prepare_streaming_aggregation(bookings_table, connection)
+
+                plan = _run_aggregate_report_query(bookings_table, shadow_table_name, connection,
+                                                   explain, fx_rates_table)
+
+            # Atomically swap report table with shadow table, locking report table only briefly
+            _swap_tables(report_table_name, shadow_table_name, connection)
+
+        finally:
+            with connection.begin():
+                _run_advisory_lock_query(report_table_name, connection, unlock=True)
+
+    return plan
+
+
+def aggregate_preview_report(bookings_table: MappedTable, preview_table: MappedTable,
+                             sample_rate: float, engine: Engine,
+                             explain: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Estimate a monthly report from a sample of bookings, and replace preview table content with it.
+
+    Bookings table is expected to hold a Bernoulli sample of bookings (each one independently kept
+    with probability `sample_rate`). Report totals are estimated by scaling sample totals up
+    (Horvitz-Thompson estimator), along with 95% confidence intervals.
+
+    Args:
+        bookings_table: source sampled bookings table mapper
+        preview_table: destination preview table mapper (see :func:`get_preview_table`)
+        sample_rate: bookings sampling probability
+        engine: sqlalchemy engine
+        explain: whether to capture the query plan of the aggregation
+
+    Returns:
+        Aggregation query plan as PostgreSQL JSON `EXPLAIN` output if `explain`, else `None`
+
+    Notes:
+        Make the operation transactional.
+        Report rows with no sampled booking are missing from preview.
+    """
+
     with engine.begin() as connection:
-        # Truncate already-existing report table
-        _run_truncate_query(report_table, connection)
+        # Truncate already-existing preview table
+        _run_truncate_query(preview_table, connection)
 
-        # Recreate report
-        _run_aggregate_report_query(bookings_table, report_table, connection)
+        # Recreate preview
+        return _run_aggregate_preview_query(bookings_table, preview_table, sample_rate,
+                                            connection, explain)
 
 
 def _run_truncate_query(table: MappedTable, connection: Connection) -> sqlalchemy.Text:
@@ -31,44 +143,271 @@ def _run_truncate_query(table: MappedTable, connection: Connection) -> sqlalchem
     connection.execute(truncate_query)
 
 
-def _run_aggregate_report_query(bookings_table: MappedTable, report_table: MappedTable,
-                                connection: Connection):
+def _prepare_streaming_aggregation(bookings_table: MappedTable, connection: Connection):
+    # Without an index to read bookings in group order from, disabling hash aggregation only
+    # trades it for a full (spilling) sort of bookings
+    index = get_bookings_index(bookings_table, 'restaurant_month')
+
+    if create_index(index, connection):
+        # Refresh planner statistics (including on indexed expression)
+        connection.execute(sqlalchemy.text(f'ANALYZE {bookings_table.__tablename__}'))
+
+    # Only for the duration of the transaction
+    connection.execute(sqlalchemy.text('SET LOCAL enable_hashagg = off'))
+
+
+def _run_advisory_lock_query(table_name: str, connection: Connection, unlock: bool = False):
+    # Session-level lock, held across transactions until explicitly released; keyed by
+    # schema-qualified table name, which (unlike table OID) is kept across swaps
+    lock_function = 'pg_advisory_unlock' if unlock else 'pg_advisory_lock'
+    lock_query = sqlalchemy.text(f'''
+    SELECT {lock_function}(hashtext(CAST(relnamespace AS regnamespace)::text || '.' || relname))
+    FROM pg_class
+    WHERE oid = CAST(:table_name AS regclass)
+    ''')
+    connection.execute(lock_query, table_name=table_name)
+
+
+def _run_create_shadow_table_query(table_name: str, shadow_table_name: str,
+                                   connection: Connection):
+    connection.execute(sqlalchemy.text(f'DROP TABLE IF EXISTS {shadow_table_name}'))
+    connection.execute(sqlalchemy.text(f'CREATE TABLE {shadow_table_name} '
+                                       f'(LIKE {table_name} INCLUDING ALL)'))
+
+
+def _swap_tables(table_name: str, shadow_table_name: str, connection: Connection):
+    attempt = 1
+
+    while True:
+        try:
+            with connection.begin():
+                _run_swap_tables_query(table_name, shadow_table_name, connection)
+            return
+
+        except sqlalchemy.exc.OperationalError as e:
+            if getattr(e.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE or \
+                    attempt == SWAP_MAX_ATTEMPTS:
+                raise
+
+            delay = SWAP_RETRY_DELAY * 2 ** (attempt - 1)
+            LOGGER.warning(f'Report table {table_name} is in use; retrying swap in {delay}s '
+                           f'(attempt {attempt}/{SWAP_MAX_ATTEMPTS})')
+            time.sleep(delay)
+            attempt += 1
+
+
+def _run_swap_tables_query(table_name: str, shadow_table_name: str, connection: Connection):
+    # Give up shortly rather than queue readers behind a long wait for the exclusive lock
+    connection.execute(sqlalchemy.text(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'"))
+
+    # Primary key constraint (and index) names do not follow table renames
+    primary_key_query = sqlalchemy.text('''
+    SELECT conname
+    FROM pg_constraint
+    WHERE conrelid = CAST(:table_name AS regclass) AND contype = 'p'
+    ''')
+    primary_key_name = connection.execute(primary_key_query, table_name=table_name).scalar()
+    shadow_primary_key_name = connection.execute(primary_key_query,
+                                                 table_name=shadow_table_name).scalar()
+
+    # Readers of report table (e.g. dashboards roles) keep reading it
+    _run_copy_privileges_query(table_name, shadow_table_name, connection)
+
+    # Views follow table renames; capture their definitions (referring to report table by name)
+    # before renaming it, to point them to the new report table afterwards
+    views_query = sqlalchemy.text('''
+    SELECT DISTINCT CAST(view.oid AS regclass)::text, pg_get_viewdef(view.oid)
+    FROM pg_depend
+    JOIN pg_rewrite ON pg_depend.objid = pg_rewrite.oid
+    JOIN pg_class AS view ON pg_rewrite.ev_class = view.oid
+    WHERE pg_depend.classid = CAST('pg_rewrite' AS regclass)
+        AND pg_depend.refobjid = CAST(:table_name AS regclass)
+        AND view.relkind = 'v'
+    ''')
+    views = connection.execute(views_query, table_name=table_name).fetchall()
+
+    old_table_name = f'{table_name}_old'
+
+    connection.execute(sqlalchemy.text(f'ALTER TABLE {table_name} RENAME TO {old_table_name}'))
+    connection.execute(sqlalchemy.text(f'ALTER TABLE {shadow_table_name} RENAME TO {table_name}'))
+
+    for view_name, view_definition in views:
+        # Escape colons for view definition not to be parsed for parameters (`sqlalchemy.text()`
+        # escapes percent signs itself); views keep their own owner, privileges and dependent
+        # views
+        view_definition = view_definition.rstrip().rstrip(';').replace(':', r'\:')
+        connection.execute(sqlalchemy.text(f'CREATE OR REPLACE VIEW {view_name} AS '
+                                           f'{view_definition}'))
+
+    # Fails on remaining dependent objects (e.g. materialized views)
+    connection.execute(sqlalchemy.text(f'DROP TABLE {old_table_name}'))
+    connection.execute(sqlalchemy.text(f'ALTER TABLE {table_name} RENAME CONSTRAINT '
+                                       f'{shadow_primary_key_name} TO {primary_key_name}'))
+
+
+def _run_copy_privileges_query(table_name: str, shadow_table_name: str, connection: Connection):
+    # `CREATE TABLE ... (LIKE ...)` copies neither table owner nor privileges
+    owner_query = sqlalchemy.text('''
+    SELECT quote_ident(pg_get_userbyid(relowner))
+    FROM pg_class
+    WHERE oid = CAST(:table_name AS regclass)
+    ''')
+    owner = connection.execute(owner_query, table_name=table_name).scalar()
+
+    # Change owner first, for privileges to be granted by it
+    connection.execute(sqlalchemy.text(f'ALTER TABLE {shadow_table_name} OWNER TO {owner}'))
+
+    # No rows for default privileges (NULL access control list)
+    privileges_query = sqlalchemy.text('''
+    SELECT
+        CASE
+            WHEN acl.grantee = 0 THEN 'PUBLIC'
+            ELSE quote_ident(pg_get_userbyid(acl.grantee))
+        END AS grantee,
+        acl.privilege_type,
+        acl.is_grantable
+    FROM pg_class, aclexplode(pg_class.relacl) AS acl
+    WHERE pg_class.oid = CAST(:table_name AS regclass)
+    ''')
+
+    privileges = connection.execute(privileges_query, table_name=table_name).fetchall()
+
+    for grantee, privilege_type, is_grantable in privileges:
+        grant_option = ' WITH GRANT OPTION' if is_grantable else ''
+        connection.execute(sqlalchemy.text(f'GRANT {privilege_type} ON {shadow_table_name} '
+                                           f'TO {grantee}{grant_option}'))
+
+
+def _run_aggregate_report_query(bookings_table: MappedTable, report_table_name: str,
+                                connection: Connection, explain: bool = False,
+                                fx_rates_table: Optional[MappedTable] = None
+                                ) -> Optional[Dict[str, Any]]:
+    # `EXPLAIN ANALYZE` actually runs the query
+    explain_clause = f'EXPLAIN {EXPLAIN_OPTIONS}' if explain else ''
+
+    # Convert amounts at once for all currencies, by joining aggregated report with FX rates
+    converted_amount_column = ''
+    fx_rates_join = ''
+
+    if fx_rates_table is not None:
+        converted_amount_column = ''',
+            -- `converted_amount` is non-nullable in destination table;
+            -- Crash if FX rate is missing.
+            round(report.amount * fx_rates.rate, 2) AS converted_amount'''
+
+        fx_rates_join = f'''
+        LEFT JOIN {fx_rates_table.__tablename__} AS fx_rates
+            ON report.currency = fx_rates.currency
+            AND report.month = fx_rates.month'''
+
     agg_query = sqlalchemy.text(f'''
-    INSERT INTO {report_table.__tablename__}
+    {explain_clause}
+    INSERT INTO {report_table_name}
         WITH report AS
         (
             SELECT
                 restaurant_id,
                 restaurant_name,
                 country,
-                to_char(date, 'YYYY-MM') AS month,
+                to_char(date_trunc('month', date::timestamp), 'YYYY-MM') AS month,
                 SUM(amount) AS amount,
                 COUNT(*) AS number_of_bookings,
                 SUM(guests) AS number_of_guests,
                 currency
             FROM {bookings_table.__tablename__}
-            GROUP BY 1, 2, 3, 4, 8  -- group by currency
+            -- Restaurant and month first, as in `restaurant_month` index, for streaming
+            -- aggregation to only sort bookings within each restaurant and month
+            GROUP BY restaurant_id, date_trunc('month', date::timestamp),
+                restaurant_name, country, currency
         )
         SELECT
-            restaurant_id,
-            restaurant_name,
-            country,
-            month,
-            number_of_bookings,
-            number_of_guests,
+            report.restaurant_id,
+            report.restaurant_name,
+            report.country,
+            report.month,
+            report.number_of_bookings,
+            report.number_of_guests,
             CASE
-                WHEN currency = '€' THEN
-                    replace(amount::text || ' €', '.', ',')
+                WHEN report.currency = '€' THEN
+                    replace(report.amount::text || ' €', '.', ',')
 
-                WHEN currency = '£' THEN
-                    '£' || amount::text
+                WHEN report.currency = '£' THEN
+                    '£' || report.amount::text
 
                 ELSE
-                    -- `amount` is non-nullable in destination table;
-                    -- Crash if amount formatting fails.
-                    NULL
-            END AS amount
-        FROM report
+                    -- Any other currency symbol or code
+                    report.amount::text || ' ' || report.currency
+            END AS amount{converted_amount_column}
+        FROM report{fx_rates_join}
+    ''')
+
+    result = connection.execute(agg_query)
+
+    if explain:
+        return result.scalar()[0]
+
+
+def _run_aggregate_preview_query(bookings_table: MappedTable, preview_table: MappedTable,
+                                 sample_rate: float, connection: Connection,
+                                 explain: bool = False) -> Optional[Dict[str, Any]]:
+    # `EXPLAIN ANALYZE` actually runs the query
+    explain_clause = f'EXPLAIN {EXPLAIN_OPTIONS}' if explain else ''
+
+    # Under Bernoulli sampling with probability p, `SUM(y) / p` is an unbiased estimator of a
+    # total, and `(1 - p) / p^2 * SUM(y^2)` an unbiased estimator of its variance.
+    # Lower confidence bounds are clipped to sample totals, which are known for sure.
+
+    preview_query = sqlalchemy.text(f'''
+    {explain_clause}
+    INSERT INTO {preview_table.__tablename__}
+        WITH sample AS
+        (
+            SELECT
+                restaurant_id,
+                restaurant_name,
+                country,
+                to_char(date, 'YYYY-MM') AS month,
+                COUNT(*) AS number_of_bookings,
+                SUM(guests) AS number_of_guests,
+                SUM(guests * guests) AS number_of_guests_sq,
+                SUM(amount) AS amount,
+                SUM(amount * amount) AS amount_sq,
+                currency
+            FROM {bookings_table.__tablename__}
+            GROUP BY 1, 2, 3, 4, 10  -- group by currency
+        ),
+        estimate AS
+        (
+            SELECT
+                *,
+                number_of_bookings / :rate AS number_of_bookings_est,
+                :z * sqrt((1 - :rate) * number_of_bookings) / :rate AS number_of_bookings_err,
+                number_of_guests / :rate AS number_of_guests_est,
+                :z * sqrt((1 - :rate) * number_of_guests_sq) / :rate AS number_of_guests_err,
+                amount / :rate AS amount_est,
+                :z * sqrt((1 - :rate) * amount_sq) / :rate AS amount_err
+            FROM sample
+        )
+        SELECT
+            restaurant_id,
+            restaurant_name,
+            country,
+            month,
+            round(number_of_bookings_est),
+            round(greatest(number_of_bookings_est - number_of_bookings_err, number_of_bookings)),
+            round(number_of_bookings_est + number_of_bookings_err),
+            round(number_of_guests_est),
+            round(greatest(number_of_guests_est - number_of_guests_err, number_of_guests)),
+            round(number_of_guests_est + number_of_guests_err),
+            round(amount_est, 2),
+            round(greatest(amount_est - amount_err, amount), 2),
+            round(amount_est + amount_err, 2),
+            currency
+        FROM estimate
     ''')
 
-    connection.execute(agg_query)
+    result = connection.execute(preview_query,
+                                rate=decimal.Decimal(str(sample_rate)), z=CONFIDENCE_Z)
+
+    if explain:
+        return result.scalar()[0]
@@ -1,16 +1,12 @@
 import argparse
 import atexit
+import json
 import logging
-from csv import DictReader, DictWriter
-from io import StringIO
+import os
+import time
+from contextlib import ExitStack
 
-import sqlalchemy
-import yaml
-
-from bookings_report.aggregate import aggregate_report
-from bookings_report.psql_utils import build_psql_uri, load_from_csv, unload_to_csv
-from bookings_report.tables import get_bookings_table, get_report_table
-from bookings_report.transform import parse_amount_and_currency, parse_date
+from bookings_report import BOOKINGS_INDEX_KINDS
 
 LOGGER = logging.getLogger(__name__)
 
@@ -23,9 +19,47 @@ def main():
     parser.add_argument('--out', '-o', metavar='report_file', help='output CSV report')
     parser.add_argument('--conf', metavar='psql_conf', default='conf/psql.yaml',
                         help='YAML database configuration (default: %(default)s)')
+    parser.add_argument('--max-errors', metavar='N', type=int, default=0,
+                        help='skip up to N invalid bookings rows instead of aborting '
+                             '(default: %(default)s)')
+    parser.add_argument('--rejects', metavar='reject_file',
+                        help='output CSV receiving skipped bookings rows')
+    parser.add_argument('--chunk-size', metavar='N', type=int,
+                        help='load bookings by committed chunks of N rows')
+    parser.add_argument('--checkpoint', metavar='checkpoint_file',
+                        help='record load progress after each chunk, and resume an interrupted '
+                             'load from it')
+    parser.add_argument('--sort-buffer', metavar='N', type=int,
+                        help='load bookings sorted by restaurant and date, holding at most N rows '
+                             'in memory (spilling to disk), and aggregate them without hashing')
+    parser.add_argument('--fx-rates', metavar='fx_file',
+                        help='input CSV FX rates (currency,month,rate), adding amounts converted '
+                             'with them to report')
+    parser.add_argument('--sample', metavar='rate', type=float,
+                        help='quick preview: estimate report from a random sample of bookings, '
+                             'each one kept with probability 0 < rate <= 1')
+    parser.add_argument('--publish', action='store_true',
+                        help='build report into a shadow table swapped with report table, so that '
+                             'report readers are not blocked during aggregation')
+    parser.add_argument('--index', action='append', default=[], choices=BOOKINGS_INDEX_KINDS,
+                        help='create supporting bookings index after load (repeatable)')
+    parser.add_argument('--explain', metavar='explain_file',
+                        help='output JSON run metrics and query plans of aggregation and export')
     parser.add_argument('--verbose', '-v', action='store_true', help='verbose logging')
     args = parser.parse_args()
 
+    for name in ['chunk_size', 'sort_buffer']:
+        if getattr(args, name) is not None and getattr(args, name) < 1:
+            parser.error(f"argument --{name.replace('_', '-')}: expected N >= 1")
+
+    if args.sample is not None:
+        if not 0 < args.sample <= 1:
+            parser.error('argument --sample: expected 0 < rate <= 1')
+        if args.fx_rates:
+            parser.error('argument --sample: not allowed with argument --fx-rates')
+        if args.publish:
+            parser.error('argument --sample: not allowed with argument --publish')
+
     # Configure logging
 
     logging.basicConfig(level=logging.WARNING)
@@ -34,63 +68,170 @@ def main():
         logging.root.setLevel(logging.INFO)
         logging.getLogger('sqlalchemy').setLevel(logging.INFO)
 
-    # Connect to the database
+    # Import heavy dependencies (`sqlalchemy`, `psycopg2`, `yaml`) only once arguments are parsed,
+    # so that `--help` and argument errors are fast
+
+    import sqlalchemy
+    import yaml
+
+    from bookings_report.aggregate import aggregate_preview_report, aggregate_report
+    from bookings_report.ingest import ingest_bookings, read_checkpoint
+    from bookings_report.psql_utils import (analyze_table, build_psql_uris, create_index,
+                                            explain_query, load_from_csv)
+    from bookings_report.shard import map_shards, unload_shards_to_csv
+    from bookings_report.tables import (get_bookings_index, get_bookings_table, get_fx_rates_table,
+                                        get_preview_table, get_report_table)
+
+    # Connect to the database (or to every shard)
 
     with open(args.conf) as f:
         conf = yaml.safe_load(f)
 
-    psql_uri = build_psql_uri(**conf)
-
-    engine = sqlalchemy.create_engine(psql_uri)
+    engines = [sqlalchemy.create_engine(psql_uri) for psql_uri in build_psql_uris(conf)]
 
     # Create bookings table (temporary table)
 
     bookings_table = get_bookings_table('bookings')
 
-    # Drop bookings table if it already exists
-    bookings_table.__table__.drop(bind=engine, checkfirst=True)
-    bookings_table.__table__.create(bind=engine)
-    # Schedule drop table at end of script
-    atexit.register(lambda: bookings_table.__table__.drop(bind=engine, checkfirst=True))
+    # Resume an interrupted load, if any
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = read_checkpoint(args.checkpoint, args.bookings_file, bookings_table, engines,
+                                     args.sample or 1.0)
+
+    for engine in engines:
+        if not checkpoint:
+            # Drop bookings table if it already exists
+            bookings_table.__table__.drop(bind=engine, checkfirst=True)
+            bookings_table.__table__.create(bind=engine)
+
+        if not args.checkpoint:
+            # Schedule drop table at end of script
+            atexit.register(bookings_table.__table__.drop, bind=engine, checkfirst=True)
+
+    # Extract, transform and load booking rows into the database
+
+    start_time = time.perf_counter()
+
+    with ExitStack() as stack:
+        rejects = None
+        if args.rejects:
+            rejects = stack.enter_context(open(args.rejects, 'a' if checkpoint else 'w'))
+
+        n_loaded, n_rejected = ingest_bookings(args.bookings_file, bookings_table, engines,
+                                               args.chunk_size, args.max_errors, rejects,
+                                               args.checkpoint, checkpoint, args.sort_buffer,
+                                               args.sample or 1.0)
 
-    # Retrieve bookings table column names
-    columns = [c.key for c in bookings_table.__table__.columns]
+    LOGGER.info(f'Loaded {n_loaded} bookings rows')
+    if n_rejected:
+        LOGGER.warning(f'Rejected {n_rejected} invalid bookings rows')
 
-    # Extract data from booking file
+    metrics = {
+        'shards': len(engines),
+        'loaded_rows': n_loaded,
+        'rejected_rows': n_rejected,
+        'load_seconds': time.perf_counter() - start_time
+    }
 
-    with open(args.bookings_file) as f:
-        reader = DictReader(f)
+    # Create supporting indexes and refresh planner statistics, now that bookings are loaded
 
-        stream = StringIO()
-        writer = DictWriter(stream, fieldnames=columns)
+    start_time = time.perf_counter()
 
-        writer.writeheader()
+    def create_indexes(engine: sqlalchemy.engine.Engine):
+        for kind in args.index:
+            create_index(get_bookings_index(bookings_table, kind), engine)
 
-        # Transform booking rows for proper loading into the database
-        for row in reader:
-            row['amount'], row['currency'] = parse_amount_and_currency(raw_amount=row['amount'])
-            row['date'] = parse_date(row['date'])
-            writer.writerow(row)
+        # Refresh planner statistics, now that bookings are loaded
+        analyze_table(bookings_table, engine)
 
-    # Load booking rows into the database
-    load_from_csv(stream, bookings_table, engine)
+    map_shards(create_indexes, engines)
+
+    metrics['index_seconds'] = time.perf_counter() - start_time
+
+    # Load FX rates into the database (temporary table, on every shard)
+
+    fx_rates_table = None
+
+    if args.fx_rates:
+        fx_rates_table = get_fx_rates_table('fx_rates')
+
+        for engine in engines:
+            # Drop FX rates table if it already exists
+            fx_rates_table.__table__.drop(bind=engine, checkfirst=True)
+            fx_rates_table.__table__.create(bind=engine)
+            # Schedule drop table at end of script
+            atexit.register(fx_rates_table.__table__.drop, bind=engine, checkfirst=True)
+
+            with open(args.fx_rates) as f:
+                load_from_csv(f, fx_rates_table, engine)
 
     # Access report table
 
-    report_table = get_report_table('monthly_restaurant_report')
+    if args.sample:
+        report_table = get_preview_table('monthly_restaurant_report_preview')
+    elif fx_rates_table is None:
+        report_table = get_report_table('monthly_restaurant_report')
+    else:
+        report_table = get_report_table('monthly_restaurant_report_converted', converted=True)
 
     # Create report table if it does not exist
-    report_table.__table__.create(bind=engine, checkfirst=True)
-
-    # Perform report aggregation
-    aggregate_report(bookings_table, report_table, engine)
+    for engine in engines:
+        report_table.__table__.create(bind=engine, checkfirst=True)
+
+    # Perform report aggregation (on every shard, in parallel)
+
+    start_time = time.perf_counter()
+
+    def aggregate(engine: sqlalchemy.engine.Engine):
+        if args.sample:
+            return aggregate_preview_report(bookings_table, report_table, args.sample, engine,
+                                            explain=args.explain is not None)
+        else:
+            return aggregate_report(bookings_table, report_table, engine,
+                                    explain=args.explain is not None,
+                                    fx_rates_table=fx_rates_table,
+                                    streaming=args.sort_buffer is not None,
+                                    publish=args.publish)
+
+    # One query plan per shard
+    try:
+        plans = {'aggregate': map_shards(aggregate, engines)}
+    except Exception:
+        if len(engines) > 1:
+            # Shard aggregations are committed independently
+            LOGGER.error('Report aggregation failed on some shards: shard reports may be '
+                         'inconsistent with each other (some rebuilt, some not); rerun to rebuild '
+                         'all of them')
+        raise
+
+    metrics['aggregate_seconds'] = time.perf_counter() - start_time
 
     # Export to CSV
 
     if args.out:
         with open(args.out, 'w') as f:
             LOGGER.info(f'Writing report to {args.out}')
-            unload_to_csv(report_table, f, engine)
+            # Restaurants (thus report rows) do not span several shards
+            unload_shards_to_csv(report_table, f, engines)
+
+    # Export run metrics and query plans
+
+    if args.explain:
+        # `COPY` cannot be explained; explain the query it is equivalent to
+        export_query = f'SELECT * FROM {report_table.__tablename__}'
+        plans['export'] = [explain_query(export_query, engine) for engine in engines]
+
+        with open(args.explain, 'w') as f:
+            LOGGER.info(f'Writing run metrics and query plans to {args.explain}')
+            json.dump({'metrics': metrics, 'plans': plans}, f, indent=2)
+
+    # Clean up a completed checkpointed load
+
+    if args.checkpoint:
+        for engine in engines:
+            bookings_table.__table__.drop(bind=engine, checkfirst=True)
+        os.remove(args.checkpoint)
 
 
 if __name__ == '__main__':
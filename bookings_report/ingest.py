@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import random
+from contextlib import ExitStack
+from csv import DictReader, DictWriter
+from io import StringIO
+from itertools import chain
+from typing import Any, Dict, List, Optional, TextIO, Tuple, Union
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.declarative import declarative_base
+
+from bookings_report.psql_utils import CSVRowStream, load_from_csv
+from bookings_report.shard import ShardRouter, map_shards
+from bookings_report.sort import ExternalSorter
+from bookings_report.transform import REJECT_FIELDS, transform_bookings
+
+LOGGER = logging.getLogger(__name__)
+
+MappedTable = declarative_base()
+
+Checkpoint = Dict[str, Any]
+
+# Bookings load order, clustering bookings by report row
+SORT_COLUMNS = ['restaurant_id', 'date']
+
+
+def ingest_bookings(bookings_file: str, bookings_table: MappedTable,
+                    engine: Union[Engine, List[Engine]],
+                    chunk_size: Optional[int] = None, max_errors: int = 0,
+                    rejects: Optional[TextIO] = None, checkpoint_file: Optional[str] = None,
+                    checkpoint: Optional[Checkpoint] = None,
+                    sort_buffer_size: Optional[int] = None, sample_rate: float = 1.0,
+                    rng: Optional[random.Random] = None) -> Tuple[int, int]:
+    """
+    Transform CSV bookings and load them into a bookings table.
+
+    Bookings are optionally sharded across several databases by restaurant (see
+    :class:`ShardRouter`), each shard being loaded in parallel.
+
+    Bookings are loaded by chunks of `chunk_size` rows, each one committed separately. Progress is
+    recorded into `checkpoint_file` after each chunk, so that an interrupted load can be resumed
+    from the last committed chunk.
+
+    Bookings are optionally sorted by :data:`SORT_COLUMNS` before being loaded (within each chunk),
+    holding no more than `sort_buffer_size` rows in memory, so that bookings table is physically
+    clustered by report row.
+
+    Bookings are optionally Bernoulli-sampled with probability `sample_rate` before being
+    transformed, for a quick approximate report (see :func:`aggregate_preview_report`).
+
+    Args:
+        bookings_file: input CSV bookings
+        bookings_table: already-created bookings table (on every shard)
+        engine: sqlalchemy engine, or list of shard engines
+        chunk_size: number of source rows per chunk (default: single chunk)
+        max_errors: maximum number of invalid rows to skip before aborting
+        rejects: writable stream receiving skipped rows (see :func:`transform_bookings`)
+        checkpoint_file: JSON file receiving progress after each chunk
+        checkpoint: progress of an interrupted load to resume (see :func:`read_checkpoint`)
+        sort_buffer_size: maximum number of rows held in memory while sorting, across all
+            shards (default: no sort)
+        sample_rate: probability of loading each source row
+        rng: random number generator used for sampling (default: :mod:`random` module)
+
+    Returns:
+        Total number of loaded rows and rejected rows (sampled rows only)
+
+    Raises:
+        :exc:`NotImplementedError` on invalid row, once more than `max_errors` rows are invalid.
+    """
+
+    columns = [c.key for c in bookings_table.__table__.columns]
+
+    engines = engine if isinstance(engine, list) else [engine]
+    n_shards = len(engines)
+
+    resume = checkpoint is not None
+    if not resume:
+        checkpoint = _init_checkpoint(bookings_file, n_shards, sample_rate)
+
+    with open(bookings_file, 'rb') as f:
+        reader = DictReader(line.decode('utf-8') for line in f)
+
+        reject_fieldnames = REJECT_FIELDS + reader.fieldnames
+        if rejects and not resume:
+            DictWriter(rejects, fieldnames=reject_fieldnames).writeheader()
+
+        if resume:
+            LOGGER.info(f"Resuming load of {bookings_file} from line {checkpoint['line']}")
+            f.seek(checkpoint['offset'])
+        else:
+            checkpoint['offset'] = f.tell()
+            checkpoint['line'] = reader.line_num
+
+        line_offset = checkpoint['line'] - reader.line_num
+
+        while True:
+            with ExitStack() as stack:
+                reject_stream = StringIO()
+                reject_writer = DictWriter(reject_stream, fieldnames=reject_fieldnames)
+
+                if sort_buffer_size:
+                    writers = [stack.enter_context(ExternalSorter(
+                        columns, SORT_COLUMNS, max(sort_buffer_size // n_shards, 1)))
+                        for _ in range(n_shards)]
+                else:
+                    streams = [StringIO() for _ in range(n_shards)]
+                    writers = [DictWriter(stream, fieldnames=columns) for stream in streams]
+                    for writer in writers:
+                        writer.writeheader()
+
+                writer = ShardRouter(writers) if n_shards > 1 else writers[0]
+
+                # Transform booking rows for proper loading into the database
+                n_transformed, n_rejected = transform_bookings(
+                    reader, writer, max_errors - checkpoint['rejected'], reject_writer,
+                    max_rows=chunk_size, line_offset=line_offset, sample_rate=sample_rate,
+                    rng=rng)
+
+                if sort_buffer_size:
+                    # Stream sorted rows to the database as they are merged, rather than writing
+                    # them all somewhere first
+                    streams = [CSVRowStream(chain([columns], sorter)) for sorter in writers]
+
+                if not n_transformed and not n_rejected:
+                    break
+
+                # Load and commit chunk (on every shard)
+                if n_transformed:
+                    map_shards(load_from_csv, streams, [bookings_table] * n_shards, engines)
+
+                if rejects:
+                    rejects.write(reject_stream.getvalue())
+                    rejects.flush()
+
+                # Record progress
+                checkpoint['offset'] = f.tell()
+                checkpoint['line'] = line_offset + reader.line_num
+                checkpoint['rows'] += n_transformed
+                checkpoint['rejected'] += n_rejected
+
+                if checkpoint_file:
+                    write_checkpoint(checkpoint_file, checkpoint)
+
+                LOGGER.info(f"Loaded {checkpoint['rows']} bookings rows "
+                            f"up to line {checkpoint['line']}")
+
+    return checkpoint['rows'], checkpoint['rejected']
+
+
+def read_checkpoint(checkpoint_file: str, bookings_file: str, bookings_table: MappedTable,
+                    engine: Union[Engine, List[Engine]],
+                    sample_rate: float = 1.0) -> Optional[Checkpoint]:
+    """
+    Read progress of an interrupted bookings load, if it can be resumed.
+
+    Args:
+        checkpoint_file: JSON file written by :func:`ingest_bookings`
+        bookings_file: input CSV bookings
+        bookings_table: bookings table being loaded
+        engine: sqlalchemy engine, or list of shard engines
+        sample_rate: probability of loading each source row (see :func:`ingest_bookings`)
+
+    Returns:
+        Checkpoint, or `None` if missing or not matching input file, load options changing
+        bookings table content (sample rate, number of shards), or bookings table content
+    """
+
+    if not os.path.exists(checkpoint_file):
+        return None
+
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+
+    file_info = _get_file_info(bookings_file)
+
+    if any(checkpoint.get(key) != value for key, value in file_info.items()):
+        LOGGER.warning(f'Checkpoint {checkpoint_file} does not match {bookings_file}; ignoring')
+        return None
+
+    engines = engine if isinstance(engine, list) else [engine]
+
+    # Resuming with other options would mix rows sampled at different rates, or routed to
+    # different shards, into bookings table
+    load_options = _get_load_options(len(engines), sample_rate)
+    changed_options = [f'{key} {checkpoint.get(key)} -> {value}'
+                       for key, value in load_options.items() if checkpoint.get(key) != value]
+
+    if changed_options:
+        LOGGER.warning(f'Checkpoint {checkpoint_file} was recorded with other load options '
+                       f"({', '.join(changed_options)}); ignoring")
+        return None
+
+    if not all(engine.has_table(bookings_table.__tablename__) for engine in engines):
+        LOGGER.warning(f'Checkpoint {checkpoint_file} refers to a missing bookings table; '
+                       'ignoring')
+        return None
+
+    # Detect chunks committed (on some shards) after the last checkpoint
+    count_query = sqlalchemy.text(f'SELECT COUNT(*) FROM {bookings_table.__tablename__}')
+    n_rows = sum(engine.execute(count_query).scalar() for engine in engines)
+
+    if n_rows != checkpoint['rows']:
+        LOGGER.warning(f"Checkpoint {checkpoint_file} records {checkpoint['rows']} rows, "
+                       f'bookings table holds {n_rows}; ignoring')
+        return None
+
+    return checkpoint
+
+
+def write_checkpoint(checkpoint_file: str, checkpoint: Checkpoint):
+    """
+    Atomically write progress of a bookings load.
+
+    Args:
+        checkpoint_file: destination JSON file
+        checkpoint: progress to record
+    """
+
+    tmp_file = f'{checkpoint_file}.tmp'
+
+    with open(tmp_file, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_file, checkpoint_file)
+
+
+def _init_checkpoint(bookings_file: str, n_shards: int, sample_rate: float) -> Checkpoint:
+    return {**_get_file_info(bookings_file), **_get_load_options(n_shards, sample_rate),
+            'offset': 0, 'line': 0, 'rows': 0, 'rejected': 0}
+
+
+def _get_load_options(n_shards: int, sample_rate: float) -> Dict[str, Any]:
+    # Options changing which rows bookings table holds (unlike chunk size or sort buffer size)
+    return {'shards': n_shards, 'sample_rate': sample_rate}
+
+
+def _get_file_info(bookings_file: str) -> Dict[str, Any]:
+    stat = os.stat(bookings_file)
+
+    # Modification time catches same-size edits (e.g. fixing a date format after a rejected run)
+    return {
+        'bookings_file': os.path.abspath(bookings_file),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns
+    }
@@ -1,13 +1,18 @@
+import io
 import logging
-from typing import TextIO
+from csv import writer as csv_writer
+from typing import Any, Dict, Iterable, List, TextIO, Union
 
-from sqlalchemy.engine import Engine
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.ext.declarative import declarative_base
 
 SQLALCHEMY_LOGGER = logging.getLogger('sqlalchemy.engine')
 
 MappedTable = declarative_base()
 
+EXPLAIN_OPTIONS = '(ANALYZE, BUFFERS, FORMAT JSON)'
+
 
 def build_psql_uri(host: str, port: str, user: str, pwd: str, db: str) -> str:
     """
@@ -16,17 +21,82 @@ def build_psql_uri(host: str, port: str, user: str, pwd: str, db: str) -> str:
     return f'postgresql+psycopg2://{user}:{pwd}@{host}:{port}/{db}'
 
 
+def build_psql_uris(conf: Dict[str, Any]) -> List[str]:
+    """
+    Generate PostgreSQL connection URLs of every shard.
+
+    Args:
+        conf: database configuration, either holding a single database connection parameters
+            (see :func:`build_psql_uri`), or a list of them under key `shards`
+    """
+
+    shard_confs = conf['shards'] if 'shards' in conf else [conf]
+    return [build_psql_uri(**shard_conf) for shard_conf in shard_confs]
+
+
+class CSVRowStream(io.TextIOBase):
+    """
+    Readable stream of CSV rows, rendered as they are read rather than all at once.
+
+    It lets rows be streamed to :func:`load_from_csv` straight from an iterator (e.g. merging
+    sorted rows, see :class:`ExternalSorter`), without holding nor writing the whole CSV first.
+
+    Args:
+        rows: rows, as lists of values (header row included, if any)
+
+    Examples:
+        >>> stream = CSVRowStream([['a', 'b'], [1, 'x'], [2, 'y']])
+        >>> stream.read(6)
+        'a,b\\r\\n1'
+        >>> stream.read()
+        ',x\\r\\n2,y\\r\\n'
+        >>> stream.read()
+        ''
+    """
+
+    def __init__(self, rows: Iterable[List[Any]]):
+        self._rows = iter(rows)
+        self._pending = ''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        """
+        Read up to `size` characters (all remaining ones if negative), `''` once exhausted.
+        """
+
+        buffer = io.StringIO()
+        buffer.write(self._pending)
+        writer = csv_writer(buffer)
+
+        if size is None or size < 0 or buffer.tell() < size:
+            for row in self._rows:
+                writer.writerow(row)
+                if size is not None and 0 <= size <= buffer.tell():
+                    break
+
+        data = buffer.getvalue()
+        if size is None or size < 0:
+            size = len(data)
+
+        self._pending = data[size:]
+        return data[:size]
+
+
 def load_from_csv(stream: TextIO, table: MappedTable, engine: Engine):
     """
     Efficiently load a CSV to a PostgreSQL table.
 
     Args:
-        stream: readable stream (file, `StringIO`, ...) containing the source CSV
+        stream: readable stream (file, `StringIO`, :class:`CSVRowStream`, ...) containing the
+            source CSV, read from its start if seekable
         table: already-created PostgreSQL table
         engine: sqlalchemy engine
     """
 
-    stream.seek(0)
+    if stream.seekable():
+        stream.seek(0)
 
     connection = engine.raw_connection()
     cursor = connection.cursor()
@@ -64,3 +134,67 @@ def unload_to_csv(table: MappedTable, stream: TextIO, engine: Engine):
 
     connection.commit()
     cursor.close()
+
+
+def explain_query(query: str, engine: Engine) -> Dict[str, Any]:
+    """
+    Run a query and capture its execution plan.
+
+    Args:
+        query: SQL query
+        engine: sqlalchemy engine
+
+    Returns:
+        Query plan as PostgreSQL JSON `EXPLAIN` output
+
+    Notes:
+        The query is rolled back, so that it can be explained without side effect.
+    """
+
+    connection = engine.connect()
+    transaction = connection.begin()
+
+    try:
+        explain_query = sqlalchemy.text(f'EXPLAIN {EXPLAIN_OPTIONS} {query}')
+        return connection.execute(explain_query).scalar()[0]
+
+    finally:
+        transaction.rollback()
+        connection.close()
+
+
+def analyze_table(table: MappedTable, engine: Engine):
+    """
+    Collect PostgreSQL planner statistics about a table.
+
+    Args:
+        table: PostgreSQL table to analyze
+        engine: sqlalchemy engine
+    """
+
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text(f'ANALYZE {table.__tablename__}'))
+
+
+def create_index(index: sqlalchemy.Index, bind: Union[Engine, Connection]) -> bool:
+    """
+    Create a PostgreSQL index, unless an index of the same name already exists.
+
+    Args:
+        index: sqlalchemy index
+        bind: sqlalchemy engine, or connection (to create index within its transaction)
+
+    Returns:
+        Whether index was created
+
+    Notes:
+        Existing indexes are looked up by name rather than reflected, since sqlalchemy does not
+        reflect expression indexes.
+    """
+
+    exists_query = sqlalchemy.text('SELECT to_regclass(:index_name) IS NOT NULL')
+    if bind.execute(exists_query, index_name=index.name).scalar():
+        return False
+
+    index.create(bind=bind)
+    return True
@@ -0,0 +1,130 @@
+import logging
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from typing import Any, Callable, Dict, List, TextIO
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.declarative import declarative_base
+
+from bookings_report.psql_utils import unload_to_csv
+
+LOGGER = logging.getLogger(__name__)
+
+MappedTable = declarative_base()
+
+# Bookings are sharded by restaurant, so that every report row is computed on a single shard
+SHARD_KEY = 'restaurant_id'
+
+
+def get_shard_index(key: str, n_shards: int) -> int:
+    """
+    Get the shard a key belongs to, stable across processes (unlike builtin :func:`hash`).
+
+    Key is normalized to its canonical UUID form first, so that every spelling of a UUID (case,
+    surrounding spaces, braces, ...) belongs to the same shard, as in database.
+
+    Args:
+        key: sharding key value (UUID)
+        n_shards: number of shards
+
+    Raises:
+        :exc:`ValueError` on invalid UUID.
+
+    Examples:
+        >>> get_shard_index('81b15746-2dcb-4b3b-92ac-49cf8865e26b', 4)
+        0
+
+        >>> get_shard_index(' 81B15746-2DCB-4B3B-92AC-49CF8865E26B ', 4)
+        0
+    """
+
+    key = str(uuid.UUID(key.strip()))
+    return zlib.crc32(key.encode('utf-8')) % n_shards
+
+
+class ShardRouter:
+    """
+    Route CSV rows to per-shard writers by :data:`SHARD_KEY`.
+
+    It is written to as a :class:`csv.DictWriter`.
+
+    Args:
+        writers: per-shard writers (:class:`csv.DictWriter` or alike)
+    """
+
+    def __init__(self, writers: List[Any]):
+        self.writers = writers
+
+    def writerow(self, row: Dict[str, Any]):
+        shard_index = get_shard_index(row[SHARD_KEY], len(self.writers))
+        self.writers[shard_index].writerow(row)
+
+
+def map_shards(func: Callable[..., Any], *shard_args: List[Any]) -> List[Any]:
+    """
+    Call a function on every shard in parallel, as :meth:`Executor.map` does.
+
+    Args:
+        func: function to call on every shard
+        shard_args: per-shard arguments of `func`, one list per argument (e.g. shard engines)
+
+    Returns:
+        Per-shard results
+
+    Raises:
+        The exception raised by `func` on the first failed shard, once all calls are done.
+
+    Notes:
+        Calls are not atomic across shards: when some of them fail, the others still go through
+        (e.g. commit). Failed and succeeded shards are logged.
+    """
+
+    n_shards = len(shard_args[0])
+
+    if n_shards == 1:
+        return [func(*[args[0] for args in shard_args])]
+
+    with ThreadPoolExecutor(max_workers=n_shards) as executor:
+        futures = [executor.submit(func, *args) for args in zip(*shard_args)]
+        wait(futures)
+
+    failed_shards = [shard_index for shard_index, future in enumerate(futures)
+                     if future.exception() is not None]
+
+    if failed_shards:
+        for shard_index in failed_shards:
+            LOGGER.error(f'Shard {shard_index} failed: {futures[shard_index].exception()!r}')
+
+        succeeded_shards = sorted(set(range(n_shards)) - set(failed_shards))
+        if succeeded_shards:
+            LOGGER.error(f'Shards {succeeded_shards} succeeded nonetheless: shards are '
+                         'inconsistent with each other')
+
+        raise futures[failed_shards[0]].exception()
+
+    return [future.result() for future in futures]
+
+
+def unload_shards_to_csv(table: MappedTable, stream: TextIO, engines: List[Engine]):
+    """
+    Unload a table sharded across PostgreSQL databases to a single CSV stream.
+
+    Args:
+        table: PostgreSQL table to unload, on every shard
+        stream: writable stream (file, `StringIO`, ...) receiving the unloaded CSV
+        engines: shard engines
+    """
+
+    for shard_index, engine in enumerate(engines):
+        with TemporaryFile('w+', newline='', encoding='utf-8') as shard_stream:
+            unload_to_csv(table, shard_stream, engine)
+            shard_stream.seek(0)
+
+            # Keep a single header
+            if shard_index > 0:
+                shard_stream.readline()
+
+            copyfileobj(shard_stream, stream)
@@ -0,0 +1,132 @@
+import heapq
+import logging
+import os
+from contextlib import ExitStack
+from csv import reader as csv_reader, writer as csv_writer
+from operator import itemgetter
+from tempfile import TemporaryDirectory
+from typing import Any, Dict, Iterator, List, Optional
+
+LOGGER = logging.getLogger(__name__)
+
+# Default maximum number of sorted runs merged at once (bounding open files and merge memory)
+MAX_FAN_IN = 64
+
+
+class ExternalSorter:
+    """
+    Sort CSV rows with bounded memory, by spilling sorted runs of rows to disk and merging them.
+
+    It is written to as a :class:`csv.DictWriter`, and iterated over as a :func:`csv.reader`
+    (yielding lists of values, as strings, in `fieldnames` order).
+
+    Args:
+        fieldnames: CSV columns
+        key_columns: columns to sort by, compared as strings
+        buffer_size: maximum number of rows held in memory
+        tmp_dir: directory for temporary run files (default: system temporary directory)
+        max_fan_in: maximum number of runs merged at once (at least 2); beyond that, runs are
+            merged in several passes, holding at most `max_fan_in + 1` run files open
+
+    Examples:
+        >>> with ExternalSorter(['a', 'b'], ['b'], buffer_size=2) as sorter:
+        ...     for row in [{'a': 1, 'b': 'z'}, {'a': 2, 'b': 'y'}, {'a': 3, 'b': 'x'}]:
+        ...         sorter.writerow(row)
+        ...     list(sorter)
+        [['3', 'x'], ['2', 'y'], ['1', 'z']]
+    """
+
+    def __init__(self, fieldnames: List[str], key_columns: List[str], buffer_size: int,
+                 tmp_dir: Optional[str] = None, max_fan_in: int = MAX_FAN_IN):
+        self.fieldnames = fieldnames
+        self.buffer_size = buffer_size
+        self.max_fan_in = max_fan_in
+
+        self._key = itemgetter(*[fieldnames.index(column) for column in key_columns])
+        self._buffer = []
+        self._run_files = []
+        self._n_runs = 0
+        self._tmp_dir = TemporaryDirectory(prefix='bookings_report_sort_', dir=tmp_dir)
+
+    def __enter__(self) -> 'ExternalSorter':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def writerow(self, row: Dict[str, Any]):
+        """
+        Add a row to sort, spilling buffered rows to disk once buffer is full.
+        """
+
+        # Serialize values the same way `csv.DictWriter` does, so they compare the same whether
+        # read from memory or from disk
+        self._buffer.append(['' if row[name] is None else str(row[name])
+                             for name in self.fieldnames])
+
+        if len(self._buffer) >= self.buffer_size:
+            self._spill()
+
+    def __iter__(self) -> Iterator[List[str]]:
+        self._buffer.sort(key=self._key)
+
+        if not self._run_files:
+            yield from self._buffer
+            return
+
+        # Merge oldest runs together until the remaining ones can be merged at once
+        while len(self._run_files) > self.max_fan_in:
+            self._merge_runs(self.max_fan_in)
+
+        LOGGER.info(f'Merging {len(self._run_files)} sorted runs and {len(self._buffer)} '
+                    'buffered rows')
+
+        with ExitStack() as stack:
+            runs = [csv_reader(stack.enter_context(open(run_file, newline='', encoding='utf-8')))
+                    for run_file in self._run_files]
+            yield from heapq.merge(*runs, self._buffer, key=self._key)
+
+    def close(self):
+        """
+        Remove temporary run files.
+        """
+
+        self._buffer = []
+        self._run_files = []
+        self._tmp_dir.cleanup()
+
+    def _spill(self):
+        self._buffer.sort(key=self._key)
+
+        run_file = self._new_run_file()
+        LOGGER.info(f'Spilling {len(self._buffer)} sorted rows to {run_file}')
+
+        with open(run_file, 'w', newline='', encoding='utf-8') as f:
+            csv_writer(f).writerows(self._buffer)
+
+        self._run_files.append(run_file)
+        self._buffer = []
+
+    def _merge_runs(self, n_runs: int):
+        run_files, self._run_files = self._run_files[:n_runs], self._run_files[n_runs:]
+
+        merged_run_file = self._new_run_file()
+        LOGGER.info(f'Merging {len(run_files)} sorted runs into {merged_run_file}')
+
+        with ExitStack() as stack:
+            runs = [csv_reader(stack.enter_context(open(run_file, newline='', encoding='utf-8')))
+                    for run_file in run_files]
+
+            with open(merged_run_file, 'w', newline='', encoding='utf-8') as f:
+                csv_writer(f).writerows(heapq.merge(*runs, key=self._key))
+
+        # Merged runs are appended last, so that runs are merged evenly across passes
+        self._run_files.append(merged_run_file)
+
+        for run_file in run_files:
+            os.remove(run_file)
+
+    def _new_run_file(self) -> str:
+        run_file = os.path.join(self._tmp_dir.name, f'run_{self._n_runs}.csv')
+        self._n_runs += 1
+        return run_file
@@ -1,7 +1,9 @@
-from sqlalchemy import Column, Date, Integer, Numeric, String, UniqueConstraint
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import Column, Date, Index, Integer, Numeric, String, UniqueConstraint, cast, func
+from sqlalchemy.dialects.postgresql import TIMESTAMP, UUID
 from sqlalchemy.ext.declarative import declarative_base
 
+from bookings_report import BOOKINGS_INDEX_KINDS  # noqa: F401
+
 MappedTable = declarative_base()
 
 
@@ -29,12 +31,50 @@ def get_bookings_table(table_name: str) -> MappedTable:
     return Bookings
 
 
-def get_report_table(table_name: str) -> MappedTable:
+def get_bookings_index(bookings_table: MappedTable, kind: str) -> Index:
+    """
+    Get an optional bookings table index supporting report aggregation.
+
+    Args:
+        bookings_table: bookings table mapper
+        kind: index kind, among :data:`BOOKINGS_INDEX_KINDS`:
+            * `restaurant_month`: B-tree index on `(restaurant_id, date_trunc('month', date))`,
+              matching report grouping
+            * `date_brin`: BRIN index on `date`, for time range scans on large tables
+
+    Notes:
+        Indexes are meant to be created after bookings are loaded. Hence they are not part of the
+        table definition: creating the table never creates them.
+    """
+
+    table_name = bookings_table.__tablename__
+    columns = bookings_table.__table__.c
+
+    if kind == 'restaurant_month':
+        # Immutable (hence indexable) on a timestamp without time zone, unlike on a date
+        month = func.date_trunc('month', cast(columns.date, TIMESTAMP))
+        index = Index(f'{table_name}_restaurant_id_month_idx', columns.restaurant_id, month)
+
+    elif kind == 'date_brin':
+        index = Index(f'{table_name}_date_brin_idx', columns.date, postgresql_using='brin')
+
+    else:
+        raise NotImplementedError(f"Unrecognized bookings index kind '{kind}'")
+
+    # Building an index from table columns registers it on the table; detach it
+    bookings_table.__table__.indexes.discard(index)
+
+    return index
+
+
+def get_report_table(table_name: str, converted: bool = False) -> MappedTable:
     """
     Get sqlalchemy's report table mapper.
 
     Args:
         table_name: table name in database
+        converted: whether to add a `converted_amount` column, holding amount converted to a
+            single currency (see :func:`get_fx_rates_table`)
     """
 
     class Report(MappedTable):
@@ -48,4 +88,60 @@ def get_report_table(table_name: str) -> MappedTable:
         number_of_guests = Column(Integer, nullable=False)
         amount = Column(String, nullable=False)
 
+        if converted:
+            converted_amount = Column(Numeric(12, 2), nullable=False)
+
     return Report
+
+
+def get_preview_table(table_name: str) -> MappedTable:
+    """
+    Get sqlalchemy's preview report table mapper.
+
+    Preview report rows hold estimates of report figures from a sample of bookings, along with the
+    bounds of their confidence interval (`_low` and `_high` columns).
+
+    Args:
+        table_name: table name in database
+    """
+
+    class Preview(MappedTable):
+        __tablename__ = table_name
+
+        restaurant_id = Column(UUID, nullable=False, primary_key=True)
+        restaurant_name = Column(String, nullable=False)
+        country = Column(String, nullable=False)
+        month = Column(String, nullable=False, primary_key=True)
+        number_of_bookings = Column(Integer, nullable=False)
+        number_of_bookings_low = Column(Integer, nullable=False)
+        number_of_bookings_high = Column(Integer, nullable=False)
+        number_of_guests = Column(Integer, nullable=False)
+        number_of_guests_low = Column(Integer, nullable=False)
+        number_of_guests_high = Column(Integer, nullable=False)
+        amount = Column(Numeric(12, 2), nullable=False)
+        amount_low = Column(Numeric(12, 2), nullable=False)
+        amount_high = Column(Numeric(12, 2), nullable=False)
+        currency = Column(String, nullable=False)
+
+    return Preview
+
+
+def get_fx_rates_table(table_name: str) -> MappedTable:
+    """
+    Get sqlalchemy's FX rates table mapper.
+
+    Each row holds the rate converting one unit of `currency` (as in bookings table) into a
+    single target currency for a given month (`YYYY-MM`, as in report table).
+
+    Args:
+        table_name: table name in database
+    """
+
+    class FXRates(MappedTable):
+        __tablename__ = table_name
+
+        currency = Column(String, nullable=False, primary_key=True)
+        month = Column(String, nullable=False, primary_key=True)
+        rate = Column(Numeric, nullable=False)
+
+    return FXRates
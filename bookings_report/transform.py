@@ -1,11 +1,44 @@
+import decimal
+import logging
+import random
+import re
+import uuid
+from csv import DictReader, DictWriter
 from datetime import date, datetime
-from typing import Tuple
+from itertools import islice
+from typing import Any, Dict, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+# Extra columns prepended to invalid bookings rows in reject CSV
+REJECT_FIELDS = ['line', 'reason']
+
+# Accepted currency symbols and codes, leading or trailing amounts
+CURRENCIES = ['€', '£', '$', '¥', 'CHF', 'EUR', 'GBP', 'JPY', 'USD']
+_CURRENCY_PATTERN = '|'.join(map(re.escape, CURRENCIES))
+LEADING_CURRENCY_RE = re.compile(rf'^(?:{_CURRENCY_PATTERN})')
+TRAILING_CURRENCY_RE = re.compile(rf'(?:{_CURRENCY_PATTERN})$')
+
+# Plain decimal amount (comma or dot decimal separator), no exponent nor special values
+AMOUNT_RE = re.compile(r'[+-]?(?:\d+(?:[.,]\d*)?|[.,]\d+)')
+
+# Bookings columns cast by PostgreSQL on load; rows failing to cast are rejected beforehand,
+# rather than failing the load of a whole chunk
+UUID_COLUMNS = ['booking_id', 'restaurant_id', 'client_id']
+INTEGER_COLUMNS = ['guests']
+
+# Bookings table `amount` column is `Numeric(5, 2)`, `guests` column is `Integer`
+MAX_AMOUNT = decimal.Decimal('999.99')
+MAX_INTEGER = 2 ** 31 - 1
 
 
 def parse_amount_and_currency(raw_amount: str) -> Tuple[float, str]:
     """
     Parse raw amount string into float amount and currency.
 
+    Currency is one of :data:`CURRENCIES`, either leading (e.g. `£12.34`) or trailing
+    (e.g. `12,34 €`) the amount.
+
     Args:
         raw_amount: raw amount string
 
@@ -13,8 +46,9 @@ def parse_amount_and_currency(raw_amount: str) -> Tuple[float, str]:
         Amount and currency
 
     Raises:
-        :exc:`NotImplementedError` on invalid currency (not ending with `€` or starting with `£`).
-        :exc:`NotImplementedError` on invalid amount (comma and dot decimal separator accepted).
+        :exc:`NotImplementedError` on invalid currency (no leading or trailing known currency).
+        :exc:`NotImplementedError` on invalid amount (comma and dot decimal separator accepted, no
+            exponent, infinity or NaN).
 
     Examples:
         >>> parse_amount_and_currency('12,34 €')
@@ -22,32 +56,32 @@ def parse_amount_and_currency(raw_amount: str) -> Tuple[float, str]:
 
         >>> parse_amount_and_currency('£12.34')
         (12.34, '£')
+
+        >>> parse_amount_and_currency('12.34 CHF')
+        (12.34, 'CHF')
     """
 
     raw_amount = raw_amount.strip()
 
     error_msg = f"Cannot parse amount '{raw_amount}'"
 
-    # Parse currencu
-
-    if raw_amount.startswith('£'):
-        currency = '£'
-        raw_amount = raw_amount[1:]
+    # Parse currency (leading token first)
 
-    elif raw_amount.endswith('€'):
-        currency = '€'
-        raw_amount = raw_amount[:-1]
+    match = LEADING_CURRENCY_RE.match(raw_amount) or TRAILING_CURRENCY_RE.search(raw_amount)
 
-    else:
+    if not match:
         raise NotImplementedError(f'{error_msg}: unrecognized currency')
 
+    currency = match.group()
+    raw_amount = (raw_amount[:match.start()] + raw_amount[match.end():]).strip()
+
     # Parse amount
 
-    try:
-        amount = float(raw_amount.replace(',', '.'))
-    except ValueError:
+    if not AMOUNT_RE.fullmatch(raw_amount):
         raise NotImplementedError(f"{error_msg}: unrecognized amount '{raw_amount}'")
 
+    amount = float(raw_amount.replace(',', '.'))
+
     return amount, currency
 
 
@@ -83,3 +117,173 @@ def parse_date(raw_date: str) -> date:
             raise NotImplementedError(f"Cannot parse date '{raw_date}' as '%d-%m-%Y' or '%d/%m/%Y'")
 
     return parsed_date
+
+
+def parse_uuid(raw_uuid: str) -> str:
+    """
+    Parse raw UUID string into its canonical form.
+
+    Args:
+        raw_uuid: raw UUID string
+
+    Returns:
+        Lowercase, hyphenated UUID
+
+    Raises:
+        :exc:`NotImplementedError` on invalid UUID.
+
+    Examples:
+        >>> parse_uuid(' 81B15746-2DCB-4B3B-92AC-49CF8865E26B ')
+        '81b15746-2dcb-4b3b-92ac-49cf8865e26b'
+    """
+
+    raw_uuid = raw_uuid.strip()
+
+    try:
+        return str(uuid.UUID(raw_uuid))
+    except ValueError:
+        raise NotImplementedError(f"Cannot parse UUID '{raw_uuid}'")
+
+
+def parse_integer(raw_integer: str) -> int:
+    """
+    Parse raw integer string, within PostgreSQL `Integer` range.
+
+    Args:
+        raw_integer: raw integer string
+
+    Returns:
+        Parsed integer
+
+    Raises:
+        :exc:`NotImplementedError` on invalid or out of range integer.
+
+    Examples:
+        >>> parse_integer(' 12 ')
+        12
+    """
+
+    raw_integer = raw_integer.strip()
+
+    if not re.fullmatch(r'[+-]?\d+', raw_integer) or abs(int(raw_integer)) > MAX_INTEGER:
+        raise NotImplementedError(f"Cannot parse integer '{raw_integer}'")
+
+    return int(raw_integer)
+
+
+def parse_booking_row(row: Dict[Optional[str], Any]) -> Dict[str, Any]:
+    """
+    Parse raw booking row for proper loading into the database.
+
+    Every value PostgreSQL would fail to load is checked, so that it fails here instead.
+
+    Args:
+        row: raw booking row, as read by :class:`csv.DictReader`
+
+    Returns:
+        Parsed booking row, with an additional `currency` column
+
+    Raises:
+        :exc:`NotImplementedError` on missing or extra values, or on invalid value.
+    """
+
+    # `csv.DictReader` stores extra values under `None` key, and fills missing ones with `None`
+    if None in row:
+        raise NotImplementedError(f'Unexpected extra values {row[None]}')
+
+    # Empty values are loaded as NULL, while every bookings column is non-nullable
+    missing_columns = [column for column, value in row.items() if not (value or '').strip()]
+    if missing_columns:
+        raise NotImplementedError(f'Missing values for columns {missing_columns}')
+
+    parsed_row = dict(row)
+
+    for column in UUID_COLUMNS:
+        if column in row:
+            parsed_row[column] = parse_uuid(row[column])
+
+    for column in INTEGER_COLUMNS:
+        if column in row:
+            parsed_row[column] = parse_integer(row[column])
+
+    parsed_row['amount'], parsed_row['currency'] = parse_amount_and_currency(row['amount'])
+
+    # Amount as rounded by PostgreSQL
+    rounded_amount = decimal.Decimal(str(parsed_row['amount'])).quantize(
+        decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+
+    if abs(rounded_amount) > MAX_AMOUNT:
+        raise NotImplementedError(f"Cannot load amount '{row['amount']}': out of range")
+
+    parsed_row['date'] = parse_date(row['date'])
+
+    return parsed_row
+
+
+def transform_bookings(reader: DictReader, writer: DictWriter, max_errors: int = 0,
+                       reject_writer: Optional[DictWriter] = None, max_rows: Optional[int] = None,
+                       line_offset: int = 0, sample_rate: float = 1.0,
+                       rng: Optional[random.Random] = None) -> Tuple[int, int]:
+    """
+    Transform booking rows for proper loading into the database.
+
+    Invalid rows (see :func:`parse_booking_row`) are skipped as long as there are no more than
+    `max_errors` of them. They are written to `reject_writer`, if any, along with their line
+    number and rejection reason.
+
+    Rows are optionally Bernoulli-sampled (each one independently kept with probability
+    `sample_rate`) before being transformed.
+
+    Args:
+        reader: source CSV bookings
+        writer: destination CSV receiving transformed booking rows
+        max_errors: maximum number of invalid rows to skip before aborting
+        reject_writer: destination CSV receiving invalid booking rows, with fieldnames
+            :data:`REJECT_FIELDS` followed by source CSV fieldnames
+        max_rows: maximum number of source rows to read (default: all)
+        line_offset: number of source lines preceding `reader` content, for reporting purpose
+        sample_rate: probability of keeping each source row
+        rng: random number generator used for sampling (default: :mod:`random` module)
+
+    Returns:
+        Number of transformed rows and number of rejected rows (sampled rows only)
+
+    Raises:
+        :exc:`NotImplementedError` on invalid row, once more than `max_errors` rows are invalid.
+    """
+
+    rng = rng or random
+
+    n_transformed = 0
+    n_rejected = 0
+
+    for row in islice(reader, max_rows):
+        if sample_rate < 1 and rng.random() >= sample_rate:
+            continue
+
+        line = line_offset + reader.line_num
+
+        try:
+            transformed_row = parse_booking_row(row)
+
+        except NotImplementedError as e:
+            n_rejected += 1
+
+            if n_rejected > max_errors:
+                LOGGER.error(f'Invalid row at line {line}; '
+                             f'aborting after {n_rejected} invalid rows')
+                raise
+
+            LOGGER.info(f'Rejecting row at line {line}: {e}')
+
+            if reject_writer:
+                # Extra values (if any) are only reported in rejection reason
+                values = {column: value for column, value in row.items() if column is not None}
+                reject_writer.writerow({'line': line, 'reason': str(e), **values})
+
+            continue
+
+        writer.writerow(transformed_row)
+        n_transformed += 1
+
+    return n_transformed, n_rejected
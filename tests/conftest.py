@@ -1,14 +1,20 @@
 import os
+import uuid
+from typing import Callable, List
 
 import pytest
 import sqlalchemy
 import yaml
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
+from sqlalchemy.ext.declarative import declarative_base
 
+from bookings_report.tables import get_bookings_table
 
-@pytest.fixture(scope='session')
-def engine() -> Engine:
+MappedTable = declarative_base()
+
+
+def _create_engine(schema: str) -> Engine:
     with open(os.path.join(os.path.dirname(__file__), '..', 'conf', 'psql.yaml')) as f:
         conf = yaml.safe_load(f)
 
@@ -17,8 +23,6 @@ def engine() -> Engine:
     engine = create_engine(psql_uri)
 
     # Create test schema if necessary
-    schema = 'test'
-
     if not engine.dialect.has_schema(engine, schema):
         engine.execute(sqlalchemy.schema.CreateSchema(schema))
 
@@ -26,3 +30,49 @@ def engine() -> Engine:
     engine = create_engine(psql_uri, connect_args={'options': f'-csearch_path={schema}'})
 
     return engine
+
+
+@pytest.fixture(scope='session')
+def engine() -> Engine:
+    return _create_engine('test')
+
+
+@pytest.fixture(scope='session')
+def shard_engines() -> List[Engine]:
+    # Shards are emulated by separate schemas of the test database
+    return [_create_engine(f'test_shard_{i}') for i in range(3)]
+
+
+@pytest.fixture
+def create_table(engine) -> Callable[..., MappedTable]:
+    """
+    Get a function creating name-randomized tables, dropped at teardown.
+
+    The function takes a table mapper getter (see :mod:`bookings_report.tables`), a table name
+    prefix, extra getter keyword arguments, and optionally the engines to create the table with
+    (default: `engine`).
+    """
+
+    created_tables = []
+
+    def _create_table(get_table: Callable[..., MappedTable], name: str,
+                      engines: List[Engine] = None, **kwargs) -> MappedTable:
+        random_id = str(uuid.uuid4())[-10:]
+        table = get_table(f'{name}_{random_id}', **kwargs)
+
+        for table_engine in engines or [engine]:
+            table.__table__.create(bind=table_engine, checkfirst=True)
+            created_tables.append((table, table_engine))
+
+        return table
+
+    try:
+        yield _create_table
+    finally:
+        for table, table_engine in reversed(created_tables):
+            table.__table__.drop(bind=table_engine, checkfirst=True)
+
+
+@pytest.fixture
+def bookings_table(create_table) -> MappedTable:
+    return create_table(get_bookings_table, 'bookings')
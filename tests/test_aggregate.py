@@ -1,5 +1,9 @@
+import threading
 import uuid
+from csv import DictReader
 from datetime import date
+from decimal import Decimal
+from io import StringIO
 from typing import Any, Dict, List
 
 import mock
@@ -9,34 +13,46 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-from bookings_report.aggregate import aggregate_report
-from bookings_report.tables import get_bookings_table, get_report_table
+from bookings_report import aggregate
+from bookings_report.aggregate import aggregate_preview_report, aggregate_report
+from bookings_report.ingest import ingest_bookings
+from bookings_report.psql_utils import load_from_csv, unload_to_csv
+from bookings_report.tables import get_fx_rates_table, get_preview_table, get_report_table
 
 MappedTable = declarative_base()
 
 
 @pytest.fixture
-def bookings_table(engine) -> MappedTable:
-    random_id = str(uuid.uuid4())[-10:]
-    table = get_bookings_table(f'bookings_{random_id}')
-    table.__table__.create(bind=engine, checkfirst=True)
+def report_table(create_table) -> MappedTable:
+    return create_table(get_report_table, 'monthly_restaurant_report')
 
-    try:
-        yield table
-    finally:
-        table.__table__.drop(bind=engine, checkfirst=True)
+
+@pytest.fixture
+def converted_report_table(create_table) -> MappedTable:
+    return create_table(get_report_table, 'monthly_restaurant_report', converted=True)
 
 
 @pytest.fixture
-def report_table(engine) -> MappedTable:
-    random_id = str(uuid.uuid4())[-10:]
-    table = get_report_table(f'monthly_restaurant_report_{random_id}')
-    table.__table__.create(bind=engine, checkfirst=True)
+def fx_rates_table(create_table) -> MappedTable:
+    return create_table(get_fx_rates_table, 'fx_rates')
+
+
+@pytest.fixture
+def preview_table(create_table) -> MappedTable:
+    return create_table(get_preview_table, 'monthly_restaurant_report_preview')
+
+
+def _fill_table(table: MappedTable, rows: List[Dict[str, Any]], engine: Engine):
+    Session = sessionmaker(bind=engine)
+    session = Session()
 
     try:
-        yield table
+        for row in rows:
+            session.add(table(**row))
+        session.commit()
+
     finally:
-        table.__table__.drop(bind=engine, checkfirst=True)
+        session.close()
 
 
 def _fill_bookings_table(bookings_table: MappedTable, rows: List[Dict[str, Any]],
@@ -248,8 +264,271 @@ def test_aggregate_report(bookings_table: MappedTable, report_table: MappedTable
     assert actual_report_rows == expected_report_rows
 
 
+def test_aggregate_report_converted(bookings_table: MappedTable,
+                                    converted_report_table: MappedTable,
+                                    fx_rates_table: MappedTable, engine: Engine):
+    booking_rows = [
+        {
+            'restaurant_id': 1,
+            'amount': 1.01,
+            'currency': '€',
+            'guests': 1,
+            'date': date(2020, 1, 14)
+        },
+        {
+            'restaurant_id': 1,
+            'amount': 2.02,
+            'currency': '€',
+            'guests': 2,
+            'date': date(2020, 2, 12)
+        },
+        {
+            'restaurant_id': 2,
+            'amount': 5.55,
+            'currency': '£',
+            'guests': 5,
+            'date': date(2020, 2, 6)
+        },
+        {
+            'restaurant_id': 2,
+            'amount': 6.66,
+            'currency': '£',
+            'guests': 6,
+            'date': date(2020, 2, 21)
+        }
+    ]
+
+    _fill_bookings_table(bookings_table, booking_rows, engine)
+
+    fx_rate_rows = [
+        {'currency': '€', 'month': '2020-01', 'rate': 1},
+        {'currency': '€', 'month': '2020-02', 'rate': 1},
+        {'currency': '£', 'month': '2020-01', 'rate': 1.2},
+        {'currency': '£', 'month': '2020-02', 'rate': 1.1}
+    ]
+
+    _fill_table(fx_rates_table, fx_rate_rows, engine)
+
+    aggregate_report(bookings_table, converted_report_table, engine,
+                     fx_rates_table=fx_rates_table)
+
+    actual_report_rows = _query_report_rows(converted_report_table, engine)
+
+    actual_converted_amounts = sorted((row['restaurant_id'][-1], row['month'], row['amount'],
+                                       row['converted_amount'])
+                                      for row in actual_report_rows)
+
+    assert actual_converted_amounts == [
+        ('1', '2020-01', '1,01 €', Decimal('1.01')),
+        ('1', '2020-02', '2,02 €', Decimal('2.02')),
+        ('2', '2020-02', '£12.21', Decimal('13.43'))
+    ]
+
+
+def test_fail_aggregate_report_missing_fx_rate(bookings_table: MappedTable,
+                                               converted_report_table: MappedTable,
+                                               fx_rates_table: MappedTable, engine: Engine):
+    """
+    Make sure a missing FX rate makes aggregation crash.
+    """
+
+    booking_rows = [
+        {
+            'restaurant_id': 1,
+            'amount': 1.01,
+            'currency': '€',
+            'guests': 1,
+            'date': date(2020, 1, 1)
+        }
+    ]
+
+    _fill_bookings_table(bookings_table, booking_rows, engine)
+
+    _fill_table(fx_rates_table, [{'currency': '€', 'month': '2020-02', 'rate': 1}], engine)
+
+    with pytest.raises(sqlalchemy.exc.IntegrityError,
+                       match='null value .* violates not-null constraint'):
+        aggregate_report(bookings_table, converted_report_table, engine,
+                         fx_rates_table=fx_rates_table)
+
+
+def test_aggregate_report_converted_csv(bookings_table: MappedTable,
+                                        converted_report_table: MappedTable,
+                                        fx_rates_table: MappedTable, engine: Engine, tmp_path):
+    """
+    Make sure any currency is converted, end to end from bookings CSV to report CSV.
+    """
+
+    restaurant_ids = [str(uuid.uuid4()) for _ in range(3)]
+
+    bookings_file = tmp_path / 'bookings.csv'
+    bookings_file.write_text(
+        'booking_id,restaurant_id,restaurant_name,client_id,client_name,amount,guests,date,'
+        'country\n'
+        f'{uuid.uuid4()},{restaurant_ids[0]},A,{uuid.uuid4()},a,"10,00 €",1,01/02/2020,France\n'
+        f'{uuid.uuid4()},{restaurant_ids[1]},B,{uuid.uuid4()},b,£10.00,1,01/02/2020,UK\n'
+        f'{uuid.uuid4()},{restaurant_ids[2]},C,{uuid.uuid4()},c,10.00 CHF,1,01/02/2020,Swiss\n'
+        f'{uuid.uuid4()},{restaurant_ids[2]},C,{uuid.uuid4()},c,5.00 CHF,1,21/02/2020,Swiss\n',
+        encoding='utf-8')
+
+    ingest_bookings(str(bookings_file), bookings_table, engine)
+
+    load_from_csv(StringIO('currency,month,rate\n'
+                           '€,2020-02,1\n'
+                           '£,2020-02,1.1\n'
+                           'CHF,2020-02,0.9\n'), fx_rates_table, engine)
+
+    aggregate_report(bookings_table, converted_report_table, engine,
+                     fx_rates_table=fx_rates_table)
+
+    stream = StringIO()
+    unload_to_csv(converted_report_table, stream, engine)
+
+    report_rows = DictReader(StringIO(stream.getvalue()))
+    assert sorted((row['restaurant_name'], row['amount'], row['converted_amount'])
+                  for row in report_rows) == [
+        ('A', '10,00\u00a0€', '10.00'),
+        ('B', '£10.00', '11.00'),
+        ('C', '15.00 CHF', '13.50')
+    ]
+
+
+@pytest.mark.parametrize('sample_rate, expected_estimates', [
+    pytest.param(1, {
+        'number_of_bookings': (2, 2, 2),
+        'number_of_guests': (4, 4, 4),
+        'amount': (Decimal('3.00'), Decimal('3.00'), Decimal('3.00'))
+    }, id='exhaustive'),
+    pytest.param(0.5, {
+        # 4 +/- 1.96 * sqrt(0.5 * 2) / 0.5
+        'number_of_bookings': (4, 2, 8),
+        # 8 +/- 1.96 * sqrt(0.5 * (1 + 9)) / 0.5
+        'number_of_guests': (8, 4, 17),
+        # 6 +/- 1.96 * sqrt(0.5 * (1 + 4)) / 0.5
+        'amount': (Decimal('6.00'), Decimal('3.00'), Decimal('12.20'))
+    }, id='half')
+])
+def test_aggregate_preview_report(bookings_table: MappedTable, preview_table: MappedTable,
+                                  engine: Engine, sample_rate, expected_estimates):
+    booking_rows = [
+        {
+            'restaurant_id': 1,
+            'amount': 1,
+            'currency': '€',
+            'guests': 1,
+            'date': date(2020, 1, 14)
+        },
+        {
+            'restaurant_id': 1,
+            'amount': 2,
+            'currency': '€',
+            'guests': 3,
+            'date': date(2020, 1, 12)
+        }
+    ]
+
+    _fill_bookings_table(bookings_table, booking_rows, engine)
+
+    aggregate_preview_report(bookings_table, preview_table, sample_rate, engine)
+
+    actual_preview_rows = _query_report_rows(preview_table, engine)
+
+    assert len(actual_preview_rows) == 1
+
+    actual_preview_row = actual_preview_rows[0]
+
+    assert actual_preview_row['month'] == '2020-01'
+    assert actual_preview_row['currency'] == '€'
+
+    for name, expected_estimate in expected_estimates.items():
+        actual_estimate = tuple(actual_preview_row[column]
+                                for column in [name, f'{name}_low', f'{name}_high'])
+        assert actual_estimate == expected_estimate
+
+
+def test_aggregate_preview_report_explain(bookings_table: MappedTable,
+                                          preview_table: MappedTable, engine: Engine):
+    plan = aggregate_preview_report(bookings_table, preview_table, 0.5, engine, explain=True)
+
+    assert plan['Plan']['Node Type'] == 'ModifyTable'
+
+
+def test_aggregate_report_explain(bookings_table: MappedTable, report_table: MappedTable,
+                                  engine: Engine):
+    booking_rows = [
+        {
+            'restaurant_id': 1,
+            'amount': 1.01,
+            'currency': '€',
+            'guests': 1,
+            'date': date(2020, 1, 1)
+        }
+    ]
+
+    _fill_bookings_table(bookings_table, booking_rows, engine)
+
+    plan = aggregate_report(bookings_table, report_table, engine, explain=True)
+
+    assert plan['Plan']['Node Type'] == 'ModifyTable'
+    assert 'Shared Hit Blocks' in plan['Plan']
+
+    # Explained aggregation is actually run
+    assert len(_query_report_rows(report_table, engine)) == 1
+
+
+def _find_plan_nodes(plan: Dict[str, Any], node_type: str) -> List[Dict[str, Any]]:
+    nodes = [plan] if plan['Node Type'] == node_type else []
+    for subplan in plan.get('Plans', []):
+        nodes += _find_plan_nodes(subplan, node_type)
+    return nodes
+
+
+@pytest.mark.parametrize('streaming, expected_strategy, expected_scan, expected_presorted_keys', [
+    pytest.param(False, 'Hashed', 'Seq Scan', [], id='hashed'),
+    pytest.param(True, 'Sorted', 'Index Scan', [2], id='streaming')
+])
+def test_aggregate_report_streaming(bookings_table: MappedTable, report_table: MappedTable,
+                                    engine: Engine, streaming, expected_strategy, expected_scan,
+                                    expected_presorted_keys):
+    # Large enough for a full sort of bookings not to fit in memory
+    n_restaurants = 1000
+    n_bookings = 50000
+
+    restaurant_ids = [str(uuid.uuid4()) for _ in range(n_restaurants)]
+
+    csv = ('booking_id,restaurant_id,restaurant_name,client_id,client_name,amount,currency,'
+           'guests,date,country\n')
+    csv += ''.join(f'{uuid.uuid4()},{restaurant_ids[i % n_restaurants]},restaurant,'
+                   f'{uuid.uuid4()},client,1.01,€,1,'
+                   f'2020-{i // n_restaurants % 12 + 1:02d}-{i % 28 + 1:02d},country\n'
+                   for i in range(n_bookings))
+
+    load_from_csv(StringIO(csv), bookings_table, engine)
+
+    plan = aggregate_report(bookings_table, report_table, engine, explain=True,
+                            streaming=streaming)
+
+    aggregate_nodes = _find_plan_nodes(plan['Plan'], 'Aggregate')
+    assert [node['Strategy'] for node in aggregate_nodes] == [expected_strategy]
+
+    # Bookings are read in restaurant and month order, and only sorted (by remaining group keys)
+    # within each restaurant and month
+    assert len(_find_plan_nodes(plan['Plan'], expected_scan)) == 1
+    assert not _find_plan_nodes(plan['Plan'], 'Sort')
+
+    incremental_sort_nodes = _find_plan_nodes(plan['Plan'], 'Incremental Sort')
+    assert [len(node['Presorted Key']) for node in incremental_sort_nodes] == \
+        expected_presorted_keys
+
+    assert len(_query_report_rows(report_table, engine)) == 12 * n_restaurants
+
+
+@pytest.mark.parametrize('publish', [
+    pytest.param(False, id='truncate'),
+    pytest.param(True, id='publish')
+])
 def test_aggregate_report_transactionality(bookings_table: MappedTable,
-                                           report_table: MappedTable, engine: Engine):
+                                           report_table: MappedTable, engine: Engine, publish):
     """
     Make sure replacement of report table content is done atomically.
     """
@@ -290,7 +569,7 @@ def test_aggregate_report_transactionality(bookings_table: MappedTable,
     with pytest.raises(RuntimeError):
         with mock.patch('bookings_report.aggregate._run_aggregate_report_query',
                         side_effect=mock_run_aggregate_report_query):
-            aggregate_report(bookings_table, report_table, engine)
+            aggregate_report(bookings_table, report_table, engine, publish=publish)
 
     # Query actual report rows
 
@@ -298,18 +577,70 @@ def test_aggregate_report_transactionality(bookings_table: MappedTable,
 
     assert actual_report_rows == _create_report_results(report_rows)
 
+    # Drop leftover shadow table
+    engine.execute(f'DROP TABLE IF EXISTS {report_table.__tablename__}_shadow')
+
+
+def test_aggregate_report_publish(bookings_table: MappedTable, report_table: MappedTable,
+                                  engine: Engine):
+    booking_rows = [
+        {
+            'restaurant_id': 1,
+            'amount': 1.01,
+            'currency': '€',
+            'guests': 1,
+            'date': date(2020, 1, 1)
+        }
+    ]
+
+    _fill_bookings_table(bookings_table, booking_rows, engine)
+
+    _fill_report_table(report_table, [
+        {
+            'restaurant_id': 2,
+            'month': '2020-02',
+            'number_of_bookings': 2,
+            'number_of_guests': 2,
+            'amount': '2,02 €'
+        }
+    ], engine)
 
-def test_fail_aggregate_report_unrecognized_currency(bookings_table: MappedTable,
-                                                     report_table: MappedTable, engine: Engine):
+    expected_report_rows = _create_report_results([
+        {
+            'restaurant_id': 1,
+            'month': '2020-01',
+            'number_of_bookings': 1,
+            'number_of_guests': 1,
+            'amount': '1,01 €'
+        }
+    ])
+
+    table_name = report_table.__tablename__
+
+    # Publish several times, to make sure shadow table and constraint names are recycled (and
+    # streaming index reused)
+    for streaming in [False, True, True]:
+        aggregate_report(bookings_table, report_table, engine, streaming=streaming, publish=True)
+
+        assert _query_report_rows(report_table, engine) == expected_report_rows
+
+        inspector = sqlalchemy.inspect(engine)
+        assert inspector.get_pk_constraint(table_name)['name'] == f'{table_name}_pkey'
+        assert not engine.has_table(f'{table_name}_shadow')
+        assert not engine.has_table(f'{table_name}_old')
+
+
+def test_aggregate_report_publish_readers(bookings_table: MappedTable,
+                                          report_table: MappedTable, engine: Engine):
     """
-    Make sure invalid currency in bookings table makes aggregation crash.
+    Make sure report table owner, readers and views are kept once a report is published.
     """
 
     booking_rows = [
         {
             'restaurant_id': 1,
             'amount': 1.01,
-            'currency': '$',
+            'currency': '€',
             'guests': 1,
             'date': date(2020, 1, 1)
         }
@@ -317,8 +648,206 @@ def test_fail_aggregate_report_unrecognized_currency(bookings_table: MappedTable
 
     _fill_bookings_table(bookings_table, booking_rows, engine)
 
-    # Aggregate into report table; expect failure
+    table_name = report_table.__tablename__
+    view_name = f'{table_name}_view'
+    filtered_view_name = f'{table_name}_2020_view'
+    random_id = table_name[-10:]
+    owner_role_name = f'owner_{random_id}'
+    reader_role_name = f'reader_{random_id}'
 
-    with pytest.raises(sqlalchemy.exc.IntegrityError,
-                       match='null value .* violates not-null constraint'):
-        aggregate_report(bookings_table, report_table, engine)
+    engine.execute(f'CREATE ROLE {owner_role_name}')
+    engine.execute(f'CREATE ROLE {reader_role_name}')
+
+    try:
+        engine.execute(f'ALTER TABLE {table_name} OWNER TO {owner_role_name}')
+        engine.execute(f'CREATE VIEW {view_name} AS SELECT month, amount FROM {table_name}')
+        # View definition holding characters special to query parameters
+        engine.execute(sqlalchemy.text(f'CREATE VIEW {filtered_view_name} AS '
+                                       f'SELECT month, amount FROM {table_name} '
+                                       f"WHERE month LIKE '2020-%' AND amount <> '\\:none'"))
+        schema = engine.execute('SELECT current_schema()').scalar()
+        engine.execute(f'GRANT USAGE ON SCHEMA {schema} TO {reader_role_name}')
+        engine.execute(f'GRANT SELECT ON {table_name}, {view_name} TO {reader_role_name}')
+
+        aggregate_report(bookings_table, report_table, engine, publish=True)
+
+        owner_query = sqlalchemy.text('SELECT tableowner FROM pg_tables WHERE tablename = :name')
+        assert engine.execute(owner_query, name=table_name).scalar() == owner_role_name
+
+        with engine.begin() as connection:
+            connection.execute(f'SET LOCAL ROLE {reader_role_name}')
+
+            assert connection.execute(f'SELECT COUNT(*) FROM {table_name}').scalar() == 1
+            assert connection.execute(f'SELECT * FROM {view_name}').fetchall() == [
+                ('2020-01', '1,01\u00a0€')
+            ]
+
+        assert engine.execute(f'SELECT * FROM {filtered_view_name}').fetchall() == [
+            ('2020-01', '1,01\u00a0€')
+        ]
+
+        assert not engine.has_table(f'{table_name}_old')
+
+    finally:
+        engine.execute(f'DROP VIEW IF EXISTS {view_name}, {filtered_view_name}')
+        engine.execute(f'DROP OWNED BY {owner_role_name}, {reader_role_name}')
+        engine.execute(f'DROP ROLE {owner_role_name}, {reader_role_name}')
+
+
+@pytest.mark.parametrize('publish', [
+    pytest.param(False, id='truncate'),
+    pytest.param(True, id='publish')
+])
+def test_aggregate_report_concurrent_read(bookings_table: MappedTable, report_table: MappedTable,
+                                          engine: Engine, publish):
+    """
+    Make sure report table can only be read during aggregation when publishing.
+    """
+
+    reads = []
+
+    def read_report_table():
+        with engine.connect() as connection:
+            connection.execute("SET lock_timeout = '100ms'")
+            try:
+                connection.execute(f'SELECT * FROM {report_table.__tablename__}').fetchall()
+                reads.append('ok')
+            except sqlalchemy.exc.OperationalError:
+                reads.append('timeout')
+
+    run_aggregate_report_query = aggregate._run_aggregate_report_query
+
+    def mock_run_aggregate_report_query(*args, **kwargs):
+        # Read report table from another connection while aggregating
+        read_report_table()
+        return run_aggregate_report_query(*args, **kwargs)
+
+    with mock.patch('bookings_report.aggregate._run_aggregate_report_query',
+                    side_effect=mock_run_aggregate_report_query):
+        aggregate_report(bookings_table, report_table, engine, publish=publish)
+
+    assert reads == ['ok' if publish else 'timeout']
+
+
+def test_aggregate_report_concurrent_publish(bookings_table: MappedTable,
+                                             report_table: MappedTable, engine: Engine):
+    """
+    Make sure a publication waits for a concurrent one of the same report table to finish.
+    """
+
+    _fill_bookings_table(bookings_table, [
+        {
+            'restaurant_id': 1,
+            'amount': 1.01,
+            'currency': '€',
+            'guests': 1,
+            'date': date(2020, 1, 1)
+        }
+    ], engine)
+
+    table_name = report_table.__tablename__
+
+    # Concurrent publication in progress
+    with engine.connect() as connection:
+        aggregate._run_advisory_lock_query(table_name, connection)
+
+        try:
+            publication = threading.Thread(target=aggregate_report,
+                                           args=(bookings_table, report_table, engine),
+                                           kwargs={'publish': True})
+            publication.start()
+            publication.join(timeout=0.5)
+
+            # Shadow table of concurrent publication is left alone
+            assert publication.is_alive()
+            assert not engine.has_table(f'{table_name}_shadow')
+
+        finally:
+            aggregate._run_advisory_lock_query(table_name, connection, unlock=True)
+
+    publication.join()
+
+    assert len(_query_report_rows(report_table, engine)) == 1
+    assert not engine.has_table(f'{table_name}_shadow')
+
+
+@pytest.mark.parametrize('n_busy_attempts', [
+    pytest.param(1, id='retried'),
+    pytest.param(aggregate.SWAP_MAX_ATTEMPTS, id='exhausted')
+])
+def test_aggregate_report_publish_busy(bookings_table: MappedTable, report_table: MappedTable,
+                                       engine: Engine, n_busy_attempts):
+    """
+    Make sure report table swap is retried while a reader holds report table, and given up
+    eventually.
+    """
+
+    _fill_bookings_table(bookings_table, [
+        {
+            'restaurant_id': 1,
+            'amount': 1.01,
+            'currency': '€',
+            'guests': 1,
+            'date': date(2020, 1, 1)
+        }
+    ], engine)
+
+    # Long-running reader of report table
+    reader_connection = engine.connect()
+    reader_transaction = reader_connection.begin()
+    reader_connection.execute(f'SELECT * FROM {report_table.__tablename__}').fetchall()
+
+    delays = []
+
+    def mock_sleep(delay):
+        delays.append(delay)
+        if len(delays) == n_busy_attempts:
+            reader_transaction.rollback()
+
+    try:
+        with mock.patch('bookings_report.aggregate.time.sleep', side_effect=mock_sleep):
+            if n_busy_attempts < aggregate.SWAP_MAX_ATTEMPTS:
+                aggregate_report(bookings_table, report_table, engine, publish=True)
+                assert len(_query_report_rows(report_table, engine)) == 1
+
+            else:
+                with pytest.raises(sqlalchemy.exc.OperationalError, match='lock timeout'):
+                    aggregate_report(bookings_table, report_table, engine, publish=True)
+
+    finally:
+        if reader_transaction.is_active:
+            reader_transaction.rollback()
+        reader_connection.close()
+
+    # Exponential backoff
+    expected_delays = [aggregate.SWAP_RETRY_DELAY * 2 ** i
+                       for i in range(min(n_busy_attempts, aggregate.SWAP_MAX_ATTEMPTS - 1))]
+    assert delays == expected_delays
+
+    # Report table is left untouched after giving up
+    if n_busy_attempts == aggregate.SWAP_MAX_ATTEMPTS:
+        assert _query_report_rows(report_table, engine) == []
+        engine.execute(f'DROP TABLE {report_table.__tablename__}_shadow')
+
+
+def test_aggregate_report_other_currency(bookings_table: MappedTable,
+                                         report_table: MappedTable, engine: Engine):
+    """
+    Make sure currencies other than `€` and `£` are formatted generically.
+    """
+
+    booking_rows = [
+        {
+            'restaurant_id': 1,
+            'amount': 1.01,
+            'currency': 'CHF',
+            'guests': 1,
+            'date': date(2020, 1, 1)
+        }
+    ]
+
+    _fill_bookings_table(bookings_table, booking_rows, engine)
+
+    aggregate_report(bookings_table, report_table, engine)
+
+    assert [row['amount'] for row in _query_report_rows(report_table, engine)] == ['1.01 CHF']
@@ -0,0 +1,57 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+import bookings_report
+
+# Startup latency budget: cumulative import time of `bookings_report.cli`, in microseconds
+IMPORT_TIME_BUDGET_US = 75000
+
+LAZY_MODULES = ['sqlalchemy', 'psycopg2', 'yaml']
+
+
+def _run_python(*args: str, check: bool = True) -> subprocess.CompletedProcess:
+    env = {**os.environ, 'PYTHONPATH': os.path.dirname(os.path.dirname(bookings_report.__file__))}
+    return subprocess.run([sys.executable, *args], env=env, check=check,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def _measure_import_time() -> int:
+    # `python -X importtime` reports `import time: self [us] | cumulative [us] | module`
+    stderr = _run_python('-X', 'importtime', '-c', 'import bookings_report.cli').stderr
+    match = re.search(r'^import time:\s*\d+ \|\s*(\d+) \| bookings_report\.cli$', stderr,
+                      flags=re.MULTILINE)
+    return int(match.group(1))
+
+
+def test_cli_lazy_imports():
+    code = ('import sys, bookings_report.cli; '
+            f'print(",".join(m for m in {LAZY_MODULES} if m in sys.modules))')
+    assert _run_python('-c', code).stdout.strip() == ''
+
+
+def test_cli_import_time():
+    # Best of a few runs, to smooth out noise
+    import_time = min(_measure_import_time() for _ in range(3))
+    assert import_time < IMPORT_TIME_BUDGET_US
+
+
+def test_cli_help():
+    stdout = _run_python('-m', 'bookings_report.cli', '--help').stdout
+    assert stdout.startswith('usage: ')
+
+
+@pytest.mark.parametrize('args, expected_error', [
+    pytest.param(['--chunk-size', '0'], 'argument --chunk-size: expected N >= 1', id='chunk_size'),
+    pytest.param(['--sort-buffer', '-1'], 'argument --sort-buffer: expected N >= 1',
+                 id='sort_buffer'),
+    pytest.param(['--sample', '0'], 'argument --sample: expected 0 < rate <= 1', id='sample')
+])
+def test_fail_cli_arguments(args, expected_error):
+    result = _run_python('-m', 'bookings_report.cli', 'bookings.csv', *args, check=False)
+
+    assert result.returncode == 2
+    assert expected_error in result.stderr
@@ -0,0 +1,226 @@
+import json
+import os
+import random
+import uuid
+from csv import DictReader
+from io import StringIO
+
+import mock
+import pytest
+import sqlalchemy
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.declarative import declarative_base
+
+from bookings_report.ingest import ingest_bookings, read_checkpoint
+from bookings_report.psql_utils import load_from_csv
+
+MappedTable = declarative_base()
+
+N_ROWS = 100
+
+# Line numbers of invalid rows (header is line 1)
+INVALID_LINES = [5, 42, 77]
+
+
+@pytest.fixture
+def bookings_file(tmp_path) -> str:
+    lines = ['booking_id,restaurant_id,restaurant_name,client_id,client_name,'
+             'amount,guests,date,country']
+
+    for i in range(N_ROWS):
+        line = i + 2
+        amount = '"12,34 €"' if line != INVALID_LINES[0] else '12$34'
+        guests = i % 10 if line != INVALID_LINES[1] else 'two'
+        lines.append(f'{uuid.uuid4()},{uuid.uuid4()},Résto {i},{uuid.uuid4()},client,'
+                     f'{amount},{guests},21/03/2015,France')
+
+        # Short row
+        if line == INVALID_LINES[2]:
+            lines[-1] = lines[-1].rsplit(',', 1)[0]
+
+    path = tmp_path / 'bookings.csv'
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+    return str(path)
+
+
+def _count_rows(table: MappedTable, engine: Engine) -> int:
+    count_query = sqlalchemy.text(f'SELECT COUNT(*) FROM {table.__tablename__}')
+    return engine.execute(count_query).scalar()
+
+
+def _read_rejected_lines(rejects: StringIO):
+    return [int(row['line']) for row in DictReader(StringIO(rejects.getvalue()))]
+
+
+@pytest.mark.parametrize('chunk_size', [
+    pytest.param(None, id='single_chunk'),
+    pytest.param(7, id='chunks'),
+    pytest.param(1, id='single_row_chunks')
+])
+def test_ingest_bookings(bookings_file, bookings_table, engine, tmp_path, chunk_size):
+    rejects = StringIO()
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+
+    counts = ingest_bookings(bookings_file, bookings_table, engine, chunk_size, max_errors=3,
+                             rejects=rejects, checkpoint_file=checkpoint_file)
+
+    n_valid = N_ROWS - len(INVALID_LINES)
+    assert counts == (n_valid, len(INVALID_LINES))
+    assert _count_rows(bookings_table, engine) == n_valid
+    assert _read_rejected_lines(rejects) == INVALID_LINES
+
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+
+    assert checkpoint['line'] == N_ROWS + 1
+    assert checkpoint['rows'] == n_valid
+
+
+def test_ingest_bookings_no_checkpoint(bookings_file, bookings_table, engine):
+    counts = ingest_bookings(bookings_file, bookings_table, engine, max_errors=3)
+
+    assert counts == (N_ROWS - len(INVALID_LINES), len(INVALID_LINES))
+
+
+def test_ingest_sorted_bookings(bookings_file, bookings_table, engine):
+    counts = ingest_bookings(bookings_file, bookings_table, engine, chunk_size=50, max_errors=3,
+                             sort_buffer_size=10)
+
+    assert counts == (N_ROWS - len(INVALID_LINES), len(INVALID_LINES))
+
+    # Bookings are stored by (restaurant_id, date) within each chunk
+    select_query = sqlalchemy.text('SELECT restaurant_id, date '
+                                   f'FROM {bookings_table.__tablename__}')
+    rows = [tuple(row) for row in engine.execute(select_query)]
+
+    first_chunk_size = 50 - sum(line <= 51 for line in INVALID_LINES)
+    assert rows[:first_chunk_size] == sorted(rows[:first_chunk_size])
+    assert rows[first_chunk_size:] == sorted(rows[first_chunk_size:])
+    assert rows != sorted(rows)
+
+
+def test_resume_ingest_bookings(bookings_file, bookings_table, engine, tmp_path):
+    """
+    Make sure an interrupted load resumes from the last committed chunk.
+    """
+
+    rejects = StringIO()
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+
+    # Interrupt load on 4th chunk
+
+    n_calls = 0
+
+    def mock_load_from_csv(*args, **kwargs):
+        nonlocal n_calls
+        n_calls += 1
+        if n_calls == 4:
+            raise RuntimeError('Interrupted')
+        load_from_csv(*args, **kwargs)
+
+    with pytest.raises(RuntimeError):
+        with mock.patch('bookings_report.ingest.load_from_csv', side_effect=mock_load_from_csv):
+            ingest_bookings(bookings_file, bookings_table, engine, chunk_size=20, max_errors=3,
+                            rejects=rejects, checkpoint_file=checkpoint_file)
+
+    # Resume load
+
+    checkpoint = read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine)
+
+    assert checkpoint['line'] == 61
+    assert checkpoint['rows'] == 58
+    assert checkpoint['rejected'] == 2
+
+    counts = ingest_bookings(bookings_file, bookings_table, engine, chunk_size=20, max_errors=3,
+                             rejects=rejects, checkpoint_file=checkpoint_file,
+                             checkpoint=checkpoint)
+
+    n_valid = N_ROWS - len(INVALID_LINES)
+    assert counts == (n_valid, len(INVALID_LINES))
+    assert _count_rows(bookings_table, engine) == n_valid
+    assert _read_rejected_lines(rejects) == INVALID_LINES
+
+
+def test_resume_ingest_bookings_max_errors(bookings_file, bookings_table, engine, tmp_path):
+    """
+    Make sure errors skipped before interruption count towards `max_errors` on resume.
+    """
+
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+
+    with pytest.raises(NotImplementedError):
+        ingest_bookings(bookings_file, bookings_table, engine, chunk_size=20, max_errors=2,
+                        checkpoint_file=checkpoint_file)
+
+    checkpoint = read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine)
+
+    with pytest.raises(NotImplementedError):
+        ingest_bookings(bookings_file, bookings_table, engine, chunk_size=20, max_errors=2,
+                        checkpoint_file=checkpoint_file, checkpoint=checkpoint)
+
+
+def test_read_checkpoint_mismatch(bookings_file, bookings_table, engine, tmp_path, caplog):
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine) is None
+
+    ingest_bookings(bookings_file, bookings_table, engine, chunk_size=20, max_errors=3,
+                    checkpoint_file=checkpoint_file)
+
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine) is not None
+
+    # Other sample rate
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine,
+                           sample_rate=0.5) is None
+    assert 'other load options (sample_rate 1.0 -> 0.5)' in caplog.text
+
+    # Bookings table content not matching checkpoint (chunk committed without checkpoint)
+    engine.execute(sqlalchemy.text(f'DELETE FROM {bookings_table.__tablename__} '
+                                   "WHERE restaurant_name = 'Résto 0'"))
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine) is None
+
+    # Missing bookings table
+    bookings_table.__table__.drop(bind=engine)
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine) is None
+
+    # Modified bookings file
+    with open(bookings_file, 'a') as f:
+        f.write('\n')
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine) is None
+
+
+def test_read_checkpoint_modified_file(bookings_file, bookings_table, engine, tmp_path):
+    """
+    Make sure a checkpoint is discarded once input file is edited, even keeping its size.
+    """
+
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+
+    ingest_bookings(bookings_file, bookings_table, engine, chunk_size=20, max_errors=3,
+                    checkpoint_file=checkpoint_file)
+
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine) is not None
+
+    with open(bookings_file, encoding='utf-8') as f:
+        content = f.read()
+
+    with open(bookings_file, 'w', encoding='utf-8') as f:
+        f.write(content.replace('21/03/2015', '21-03-2015'))
+
+    # Modification time resolution may be coarser than the time elapsed since load
+    mtime_ns = os.stat(bookings_file).st_mtime_ns + 10 ** 9
+    os.utime(bookings_file, ns=(mtime_ns, mtime_ns))
+
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine) is None
+
+
+def test_read_sampled_checkpoint(bookings_file, bookings_table, engine, tmp_path):
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+
+    ingest_bookings(bookings_file, bookings_table, engine, chunk_size=20, max_errors=3,
+                    checkpoint_file=checkpoint_file, sample_rate=0.5, rng=random.Random(0))
+
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine,
+                           sample_rate=0.5) is not None
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, engine) is None
@@ -3,9 +3,11 @@ from datetime import date, timedelta
 from io import StringIO
 
 import pytest
-from sqlalchemy import Column, Date, Integer, String
+from sqlalchemy import Column, Date, Index, Integer, String
 
-from bookings_report.psql_utils import MappedTable, build_psql_uri, load_from_csv, unload_to_csv
+from bookings_report.psql_utils import (CSVRowStream, MappedTable, analyze_table,
+                                        build_psql_uri, build_psql_uris, create_index,
+                                        explain_query, load_from_csv, unload_to_csv)
 
 
 @pytest.fixture(scope='module')
@@ -44,6 +46,15 @@ def test_build_psql_uri():
     assert actual_psql_uri == expected_psql_uri
 
 
+def test_build_psql_uris():
+    conf = {'host': 'a', 'port': '1234', 'user': 'b', 'pwd': 'c', 'db': 'd'}
+    assert build_psql_uris(conf) == ['postgresql+psycopg2://b:c@a:1234/d']
+
+    shards_conf = {'shards': [conf, {**conf, 'host': 'e'}]}
+    assert build_psql_uris(shards_conf) == ['postgresql+psycopg2://b:c@a:1234/d',
+                                            'postgresql+psycopg2://b:c@e:1234/d']
+
+
 def test_load_unload_csv(fake_csv, table, engine):
     input_stream = StringIO()
     input_stream.write(fake_csv)
@@ -54,3 +65,53 @@ def test_load_unload_csv(fake_csv, table, engine):
     unload_to_csv(table, output_stream, engine)
 
     assert input_stream.getvalue() == output_stream.getvalue()
+
+
+@pytest.mark.parametrize('size', [1, 10, 100000, -1])
+def test_read_csv_row_stream(fake_csv, size):
+    stream = CSVRowStream(line.split(',') for line in fake_csv.splitlines())
+    assert stream.readable() and not stream.seekable()
+
+    chunks = list(iter(lambda: stream.read(size), ''))
+
+    assert ''.join(chunks) == fake_csv.replace('\n', '\r\n')
+    if size > 0:
+        assert max(map(len, chunks)) == min(size, len(''.join(chunks)))
+
+
+def test_load_csv_row_stream(fake_csv, table, engine):
+    rows = (line.split(',') for line in fake_csv.splitlines())
+
+    load_from_csv(CSVRowStream(rows), table, engine)
+
+    output_stream = StringIO()
+    unload_to_csv(table, output_stream, engine)
+
+    assert output_stream.getvalue() == fake_csv
+
+
+def test_explain_query(fake_csv, table, engine):
+    input_stream = StringIO()
+    input_stream.write(fake_csv)
+
+    load_from_csv(input_stream, table, engine)
+    analyze_table(table, engine)
+
+    plan = explain_query(f'DELETE FROM {table.__tablename__} WHERE a < 100', engine)
+
+    assert plan['Plan']['Node Type'] == 'ModifyTable'
+    assert plan['Plan']['Plans'][0]['Actual Rows'] == 100
+
+    # Explained query is rolled back
+    output_stream = StringIO()
+    unload_to_csv(table, output_stream, engine)
+
+    assert input_stream.getvalue() == output_stream.getvalue()
+
+
+def test_create_index(table, engine):
+    index = Index(f'{table.__tablename__}_b_c_idx', table.__table__.c.b, table.__table__.c.c)
+
+    assert create_index(index, engine)
+    # Already exists
+    assert not create_index(index, engine)
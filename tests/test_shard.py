@@ -0,0 +1,183 @@
+import uuid
+from collections import Counter
+from io import StringIO
+
+import pytest
+import sqlalchemy
+
+from bookings_report.aggregate import aggregate_report
+from bookings_report.ingest import ingest_bookings, read_checkpoint
+from bookings_report.psql_utils import unload_to_csv
+from bookings_report.shard import ShardRouter, get_shard_index, map_shards, unload_shards_to_csv
+from bookings_report.tables import get_bookings_table, get_report_table
+
+N_RESTAURANTS = 30
+
+
+@pytest.fixture
+def bookings_file(tmp_path) -> str:
+    lines = ['booking_id,restaurant_id,restaurant_name,client_id,client_name,'
+             'amount,guests,date,country']
+
+    restaurant_ids = [str(uuid.uuid4()) for _ in range(N_RESTAURANTS)]
+
+    for i in range(10 * N_RESTAURANTS):
+        restaurant_id = restaurant_ids[i % N_RESTAURANTS]
+        lines.append(f'{uuid.uuid4()},{restaurant_id},Résto {i % N_RESTAURANTS},'
+                     f'{uuid.uuid4()},client,"{i},{i % 100:02d} €",{i % 10},'
+                     f'{i % 28 + 1:02d}/{i % 12 + 1:02d}/2015,France')
+
+    path = tmp_path / 'bookings.csv'
+    path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+
+    return str(path)
+
+
+@pytest.fixture
+def tables(create_table, engine, shard_engines):
+    engines = [engine] + shard_engines
+
+    bookings_table = create_table(get_bookings_table, 'bookings', engines)
+    report_table = create_table(get_report_table, 'monthly_restaurant_report', engines)
+
+    return bookings_table, report_table
+
+
+def test_get_shard_index():
+    keys = [str(uuid.uuid4()) for _ in range(1000)]
+
+    shard_indexes = [get_shard_index(key, 4) for key in keys]
+
+    # Stable
+    assert shard_indexes == [get_shard_index(key, 4) for key in keys]
+
+    # Roughly balanced
+    counts = Counter(shard_indexes)
+    assert sorted(counts) == [0, 1, 2, 3]
+    assert min(counts.values()) > 150
+
+    # Independent of UUID spelling
+    for spell in [str.upper, lambda key: f' {key} ', lambda key: '{' + key.replace('-', '') + '}']:
+        assert [get_shard_index(spell(key), 4) for key in keys] == shard_indexes
+
+
+def test_fail_get_shard_index():
+    with pytest.raises(ValueError):
+        get_shard_index('restaurant', 4)
+
+
+def test_shard_router():
+    writers = [[], [], []]
+
+    class ListWriter:
+        def __init__(self, rows):
+            self.rows = rows
+
+        def writerow(self, row):
+            self.rows.append(row)
+
+    router = ShardRouter([ListWriter(rows) for rows in writers])
+
+    rows = [{'restaurant_id': str(uuid.uuid4()), 'i': i} for i in range(100)]
+    for row in rows:
+        router.writerow(row)
+
+    assert sum(map(len, writers)) == len(rows)
+
+    for shard_index, shard_rows in enumerate(writers):
+        for row in shard_rows:
+            assert get_shard_index(row['restaurant_id'], 3) == shard_index
+
+
+@pytest.mark.parametrize('n_shards', [1, 3])
+def test_map_shards(n_shards):
+    assert map_shards(pow, list(range(n_shards)), [2] * n_shards) == [i ** 2
+                                                                      for i in range(n_shards)]
+
+
+def test_fail_map_shards(caplog):
+    results = []
+
+    def func(i):
+        results.append(1 / i)
+
+    # Failure of a shard is raised once every other shard is done, not atomically rolled back
+    with pytest.raises(ZeroDivisionError):
+        map_shards(func, [1, 0, 2, 'a'])
+
+    assert sorted(results) == [0.5, 1]
+
+    assert 'Shard 1 failed: ZeroDivisionError' in caplog.text
+    assert 'Shard 3 failed: TypeError' in caplog.text
+    assert 'Shards [0, 2] succeeded nonetheless' in caplog.text
+
+    caplog.clear()
+
+    with pytest.raises(ZeroDivisionError):
+        map_shards(func, [0, 0])
+
+    assert 'succeeded nonetheless' not in caplog.text
+
+
+@pytest.mark.parametrize('sort_buffer_size', [
+    pytest.param(None, id='unsorted'),
+    pytest.param(10, id='sorted')
+])
+def test_sharded_report(bookings_file, tables, engine, shard_engines, sort_buffer_size):
+    """
+    Make sure sharded and non-sharded pipelines yield the same report.
+    """
+
+    bookings_table, report_table = tables
+
+    # Single database
+
+    ingest_bookings(bookings_file, bookings_table, engine)
+    aggregate_report(bookings_table, report_table, engine)
+
+    stream = StringIO()
+    unload_to_csv(report_table, stream, engine)
+    expected_lines = stream.getvalue().splitlines()
+
+    # Sharded databases
+
+    counts = ingest_bookings(bookings_file, bookings_table, shard_engines, chunk_size=100,
+                             sort_buffer_size=sort_buffer_size)
+    assert counts == (10 * N_RESTAURANTS, 0)
+
+    map_shards(lambda shard_engine: aggregate_report(bookings_table, report_table, shard_engine),
+               shard_engines)
+
+    stream = StringIO()
+    unload_shards_to_csv(report_table, stream, shard_engines)
+    actual_lines = stream.getvalue().splitlines()
+
+    # Single header
+    assert actual_lines[0] == expected_lines[0]
+    assert sorted(actual_lines[1:]) == sorted(expected_lines[1:])
+
+    # Every shard holds part of the report
+    for shard_engine in shard_engines:
+        stream = StringIO()
+        unload_to_csv(report_table, stream, shard_engine)
+        assert 1 < len(stream.getvalue().splitlines()) < len(expected_lines)
+
+
+def test_read_sharded_checkpoint(bookings_file, tables, shard_engines, tmp_path, caplog):
+    bookings_table, _ = tables
+    checkpoint_file = str(tmp_path / 'checkpoint.json')
+
+    ingest_bookings(bookings_file, bookings_table, shard_engines, chunk_size=100,
+                    checkpoint_file=checkpoint_file)
+
+    checkpoint = read_checkpoint(checkpoint_file, bookings_file, bookings_table, shard_engines)
+    assert checkpoint['rows'] == 10 * N_RESTAURANTS
+
+    # Resuming on another number of shards would route rows differently
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table,
+                           shard_engines[:2]) is None
+    assert 'other load options (shards 3 -> 2)' in caplog.text
+
+    # A chunk committed on a single shard only is detected
+    shard_engines[0].execute(sqlalchemy.text(f'DELETE FROM {bookings_table.__tablename__}'))
+    assert read_checkpoint(checkpoint_file, bookings_file, bookings_table, shard_engines) is None
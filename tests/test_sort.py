@@ -0,0 +1,74 @@
+import os
+import random
+
+import mock
+import pytest
+
+from bookings_report.sort import ExternalSorter
+
+FIELDNAMES = ['a', 'b', 'c']
+
+
+@pytest.fixture(scope='module')
+def rows():
+    rng = random.Random(0)
+    return [{'a': rng.choice('xyz'), 'b': rng.randint(0, 9), 'c': i} for i in range(1000)]
+
+
+@pytest.mark.parametrize('buffer_size', [
+    pytest.param(10000, id='in_memory'),
+    pytest.param(100, id='spill'),
+    pytest.param(1, id='single_row_runs')
+])
+def test_external_sort(rows, buffer_size, tmp_path):
+    with ExternalSorter(FIELDNAMES, ['a', 'b'], buffer_size, tmp_dir=str(tmp_path)) as sorter:
+        for row in rows:
+            sorter.writerow(row)
+
+        actual_rows = list(sorter)
+
+    # Sort is stable within runs, not across them
+    expected_rows = sorted([[str(row[name]) for name in FIELDNAMES] for row in rows])
+
+    assert sorted(actual_rows) == expected_rows
+    assert [row[:2] for row in actual_rows] == [row[:2] for row in expected_rows]
+
+    # Temporary run files are removed
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_external_sort_max_fan_in(rows, tmp_path):
+    """
+    Make sure runs are merged in several passes, with a bounded number of open run files.
+    """
+
+    open_files = []
+    max_open_files = 0
+
+    def mock_open(*args, **kwargs):
+        nonlocal max_open_files
+        open_files.append(open(*args, **kwargs))
+        max_open_files = max(max_open_files, sum(not f.closed for f in open_files))
+        return open_files[-1]
+
+    with mock.patch('bookings_report.sort.open', create=True, side_effect=mock_open):
+        with ExternalSorter(FIELDNAMES, ['a', 'b'], 1, tmp_dir=str(tmp_path),
+                            max_fan_in=8) as sorter:
+            for row in rows:
+                sorter.writerow(row)
+
+            actual_rows = list(sorter)
+
+    assert sorted(actual_rows) == sorted([[str(row[name]) for name in FIELDNAMES]
+                                          for row in rows])
+    assert actual_rows == sorted(actual_rows, key=lambda row: row[:2])
+
+    # Merged runs and a merge output
+    assert max_open_files == 8 + 1
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_external_sort_empty(tmp_path):
+    with ExternalSorter(FIELDNAMES, ['a'], 10, tmp_dir=str(tmp_path)) as sorter:
+        assert list(sorter) == []
@@ -0,0 +1,50 @@
+import pytest
+import sqlalchemy
+
+from bookings_report import BOOKINGS_INDEX_KINDS
+from bookings_report.tables import get_bookings_index
+
+
+def _get_index_definitions(table, engine):
+    # Unlike sqlalchemy inspector, includes expression indexes
+    indexes_query = sqlalchemy.text('''
+    SELECT indexname, indexdef
+    FROM pg_indexes
+    WHERE schemaname = current_schema() AND tablename = :table_name
+    ''')
+    return dict(engine.execute(indexes_query, table_name=table.__tablename__).fetchall())
+
+
+def test_create_bookings_indexes(bookings_table, engine):
+    for kind in BOOKINGS_INDEX_KINDS:
+        get_bookings_index(bookings_table, kind).create(bind=engine)
+
+    indexes = _get_index_definitions(bookings_table, engine)
+
+    table_name = bookings_table.__tablename__
+    assert sorted(indexes) == sorted([f'{table_name}_pkey',
+                                      f'{table_name}_restaurant_id_month_idx',
+                                      f'{table_name}_date_brin_idx'])
+
+    assert indexes[f'{table_name}_restaurant_id_month_idx'].endswith(
+        "USING btree (restaurant_id, "
+        "date_trunc('month'::text, (date)::timestamp without time zone))")
+    assert indexes[f'{table_name}_date_brin_idx'].endswith('USING brin (date)')
+
+
+def test_recreate_bookings_table(bookings_table, engine):
+    for kind in BOOKINGS_INDEX_KINDS:
+        get_bookings_index(bookings_table, kind)
+        get_bookings_index(bookings_table, kind)
+
+    # Indexes are not part of the table definition
+    bookings_table.__table__.drop(bind=engine)
+    bookings_table.__table__.create(bind=engine)
+
+    assert list(_get_index_definitions(bookings_table, engine)) == [
+        f'{bookings_table.__tablename__}_pkey']
+
+
+def test_fail_get_bookings_index(bookings_table):
+    with pytest.raises(NotImplementedError, match='Unrecognized bookings index kind'):
+        get_bookings_index(bookings_table, 'hash')
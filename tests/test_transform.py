@@ -1,8 +1,31 @@
+import random
+import uuid
+from csv import DictReader, DictWriter
 from datetime import date
+from io import StringIO
 
 import pytest
 
-from bookings_report.transform import parse_amount_and_currency, parse_date
+from bookings_report.transform import (REJECT_FIELDS, parse_amount_and_currency,
+                                       parse_booking_row, parse_date, parse_integer, parse_uuid,
+                                       transform_bookings)
+
+# Booking UUID of i-th row
+BOOKING_ID = '00000000-0000-0000-0000-00000000000{}'
+
+BOOKINGS_CSV = f"""\
+booking_id,amount,date
+{BOOKING_ID.format(1)},"12,34 €",21/03/2015
+{BOOKING_ID.format(2)},£1.2.3,21/03/2015
+{BOOKING_ID.format(3)},£56.78,21-03-2015
+{BOOKING_ID.format(4)},12$34,21-03-2015
+{BOOKING_ID.format(5)},£1,2015-03-21
+"""
+
+BOOKINGS_HEADER = ('booking_id,restaurant_id,restaurant_name,client_id,client_name,amount,guests,'
+                   'date,country')
+BOOKING_ROW = (f'{BOOKING_ID.format(1)},{BOOKING_ID.format(2)},Résto,{BOOKING_ID.format(3)},'
+               'client,"12,34 €",2,21/03/2015,France')
 
 
 @pytest.mark.parametrize('raw_amount, expected', [
@@ -13,19 +36,24 @@ from bookings_report.transform import parse_amount_and_currency, parse_date
     pytest.param('£12.34', (12.34, '£'), id='pounds_dot'),
     pytest.param('£56.78', (56.78, '£'), id='pounds_comma'),
     pytest.param('£123', (123, '£'), id='pounds_int'),
-    pytest.param(' £  56.78   ', (56.78, '£'), id='pounds_spaces')
+    pytest.param(' £  56.78   ', (56.78, '£'), id='pounds_spaces'),
+    pytest.param('12,34£', (12.34, '£'), id='trailing_pounds'),
+    pytest.param('€12,34', (12.34, '€'), id='leading_euro'),
+    pytest.param('$12,34', (12.34, '$'), id='leading_dollar'),
+    pytest.param('12.34 CHF', (12.34, 'CHF'), id='trailing_code'),
+    pytest.param('USD 12.', (12, 'USD'), id='leading_code'),
+    pytest.param('+.5 €', (0.5, '€'), id='signed_fraction'),
+    pytest.param('¥-5', (-5, '¥'), id='negative')
 ])
 def test_parse_amount_and_currency(raw_amount, expected):
     assert parse_amount_and_currency(raw_amount) == expected
 
 
 @pytest.mark.parametrize('raw_amount', [
-    pytest.param('12,34£', id='trailing_pounds'),
-    pytest.param('€12,34', id='leading_euro'),
-    pytest.param('$12,34', id='leading_dollar'),
-    pytest.param('12,34$', id='trailing_dollar'),
     pytest.param('12$34', id='middle_dollar'),
     pytest.param('12,34', id='no_currency'),
+    pytest.param('12,34 XYZ', id='unknown_code'),
+    pytest.param('12e', id='unknown_symbol')
 ])
 def test_fail_parse_currency(raw_amount):
     with pytest.raises(NotImplementedError, match='unrecognized currency'):
@@ -35,7 +63,11 @@ def test_fail_parse_currency(raw_amount):
 @pytest.mark.parametrize('raw_amount', [
     pytest.param('£', id='no_amount'),
     pytest.param('1a3 €', id='str_amount'),
-    pytest.param('£ 1.3 €', id='double_currency')
+    pytest.param('£ 1.3 €', id='double_currency'),
+    pytest.param('€ inf', id='infinity'),
+    pytest.param('nan £', id='nan'),
+    pytest.param('1e5 €', id='exponent'),
+    pytest.param('1_000 €', id='underscore')
 ])
 def test_fail_parse_amount(raw_amount):
     with pytest.raises(NotImplementedError, match='unrecognized amount'):
@@ -58,3 +90,158 @@ def test_parse_date(raw_date):
 def test_fail_parse_date(raw_date):
     with pytest.raises(NotImplementedError, match='Cannot parse date'):
         print('parsed =', parse_date(raw_date))
+
+
+@pytest.mark.parametrize('raw_uuid', [
+    pytest.param('81b15746-2dcb-4b3b-92ac-49cf8865e26b', id='canonical'),
+    pytest.param(' 81B15746-2DCB-4B3B-92AC-49CF8865E26B ', id='upper_spaces'),
+    pytest.param('{81b157462dcb4b3b92ac49cf8865e26b}', id='braces_no_hyphens')
+])
+def test_parse_uuid(raw_uuid):
+    assert parse_uuid(raw_uuid) == '81b15746-2dcb-4b3b-92ac-49cf8865e26b'
+
+
+@pytest.mark.parametrize('raw_uuid', [
+    pytest.param('1', id='short'),
+    pytest.param('81b15746-2dcb-4b3b-92ac-49cf8865e26z', id='not_hex')
+])
+def test_fail_parse_uuid(raw_uuid):
+    with pytest.raises(NotImplementedError, match='Cannot parse UUID'):
+        print('parsed =', parse_uuid(raw_uuid))
+
+
+@pytest.mark.parametrize('raw_integer', [
+    pytest.param('two', id='str'),
+    pytest.param('2.0', id='float'),
+    pytest.param('2147483648', id='out_of_range')
+])
+def test_fail_parse_integer(raw_integer):
+    with pytest.raises(NotImplementedError, match='Cannot parse integer'):
+        print('parsed =', parse_integer(raw_integer))
+
+
+def test_parse_booking_row():
+    row = next(DictReader(StringIO(f'{BOOKINGS_HEADER}\n{BOOKING_ROW}\n')))
+
+    assert parse_booking_row(row) == {
+        **row,
+        'amount': 12.34,
+        'currency': '€',
+        'guests': 2,
+        'date': date(2015, 3, 21)
+    }
+
+
+@pytest.mark.parametrize('raw_row, expected_reason', [
+    pytest.param(BOOKING_ROW.rsplit(',', 1)[0], 'Missing values', id='short_row'),
+    pytest.param(BOOKING_ROW + ',extra', 'Unexpected extra values', id='long_row'),
+    pytest.param(BOOKING_ROW.replace('Résto', ''), 'Missing values', id='empty_value'),
+    pytest.param(BOOKING_ROW.replace(BOOKING_ID.format(2), '2'), 'Cannot parse UUID',
+                 id='invalid_uuid'),
+    pytest.param(BOOKING_ROW.replace(',2,', ',two,'), 'Cannot parse integer',
+                 id='invalid_guests'),
+    pytest.param(BOOKING_ROW.replace('12,34 €', '1234,00 €'), 'out of range',
+                 id='out_of_range_amount'),
+    pytest.param(BOOKING_ROW.replace('12,34 €', '999,995 €'), 'out of range',
+                 id='rounded_out_of_range_amount')
+])
+def test_transform_invalid_bookings(raw_row, expected_reason):
+    """
+    Make sure rows failing to load are rejected, rather than failing the load of a whole chunk.
+    """
+
+    reader = DictReader(StringIO(f'{BOOKINGS_HEADER}\n{BOOKING_ROW}\n{raw_row}\n{BOOKING_ROW}\n'))
+    writer = DictWriter(StringIO(), fieldnames=reader.fieldnames + ['currency'])
+
+    reject_stream = StringIO()
+    reject_writer = DictWriter(reject_stream, fieldnames=REJECT_FIELDS + reader.fieldnames)
+
+    assert transform_bookings(reader, writer, max_errors=10, reject_writer=reject_writer) == (2, 1)
+
+    rejected_rows = list(DictReader(StringIO(reject_stream.getvalue()),
+                                    fieldnames=reject_writer.fieldnames))
+
+    assert [row['line'] for row in rejected_rows] == ['3']
+    assert expected_reason in rejected_rows[0]['reason']
+
+
+def _transform_bookings(max_errors: int):
+    reader = DictReader(StringIO(BOOKINGS_CSV))
+
+    stream = StringIO()
+    writer = DictWriter(stream, fieldnames=['booking_id', 'amount', 'currency', 'date'])
+
+    reject_stream = StringIO()
+    reject_writer = DictWriter(reject_stream, fieldnames=REJECT_FIELDS + reader.fieldnames)
+
+    counts = transform_bookings(reader, writer, max_errors, reject_writer)
+
+    stream.seek(0)
+    reject_stream.seek(0)
+    rows = list(DictReader(stream, fieldnames=writer.fieldnames))
+    rejected_rows = list(DictReader(reject_stream, fieldnames=reject_writer.fieldnames))
+
+    return counts, rows, rejected_rows
+
+
+def test_transform_bookings():
+    counts, rows, rejected_rows = _transform_bookings(max_errors=3)
+
+    assert counts == (2, 3)
+
+    assert rows == [
+        {'booking_id': BOOKING_ID.format(1), 'amount': '12.34', 'currency': '€',
+         'date': '2015-03-21'},
+        {'booking_id': BOOKING_ID.format(3), 'amount': '56.78', 'currency': '£',
+         'date': '2015-03-21'}
+    ]
+
+    assert [(row['line'], row['booking_id'], row['amount'], row['date'])
+            for row in rejected_rows] == [
+        ('3', BOOKING_ID.format(2), '£1.2.3', '21/03/2015'),
+        ('5', BOOKING_ID.format(4), '12$34', '21-03-2015'),
+        ('6', BOOKING_ID.format(5), '£1', '2015-03-21')
+    ]
+
+    assert 'unrecognized amount' in rejected_rows[0]['reason']
+    assert 'unrecognized currency' in rejected_rows[1]['reason']
+    assert 'Cannot parse date' in rejected_rows[2]['reason']
+
+
+@pytest.mark.parametrize('max_errors', [
+    pytest.param(0, id='no_errors'),
+    pytest.param(2, id='too_many_errors')
+])
+def test_fail_transform_bookings(max_errors):
+    with pytest.raises(NotImplementedError):
+        _transform_bookings(max_errors)
+
+
+def test_transform_bookings_max_rows():
+    reader = DictReader(StringIO(BOOKINGS_CSV))
+
+    stream = StringIO()
+    writer = DictWriter(stream, fieldnames=['booking_id', 'amount', 'currency', 'date'])
+
+    assert transform_bookings(reader, writer, max_errors=3, max_rows=2) == (1, 1)
+    assert transform_bookings(reader, writer, max_errors=3, max_rows=2) == (1, 1)
+    assert transform_bookings(reader, writer, max_errors=3, max_rows=2) == (0, 1)
+    assert transform_bookings(reader, writer, max_errors=3, max_rows=2) == (0, 0)
+
+
+@pytest.mark.parametrize('sample_rate', [0.1, 0.5])
+def test_transform_bookings_sample(sample_rate):
+    n_rows = 10000
+    csv = 'booking_id,amount,date\n'
+    csv += ''.join(f'{uuid.UUID(int=i)},£1,21/03/2015\n' for i in range(n_rows))
+
+    reader = DictReader(StringIO(csv))
+    writer = DictWriter(StringIO(), fieldnames=['booking_id', 'amount', 'currency', 'date'])
+
+    n_transformed, n_rejected = transform_bookings(reader, writer, sample_rate=sample_rate,
+                                                   rng=random.Random(0))
+
+    # Within 4 standard deviations of binomial distribution mean
+    std = (n_rows * sample_rate * (1 - sample_rate)) ** 0.5
+    assert abs(n_transformed - n_rows * sample_rate) < 4 * std
+    assert n_rejected == 0